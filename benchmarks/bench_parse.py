@@ -0,0 +1,134 @@
+"""
+Benchmark parsing of synthetic aquery output.
+
+For each size, the graph is generated once into --data-dir, and each mode is run in a fresh
+process. It parses the graph, and then reads the mnemonic, the output paths and the flattened
+inputs of every action, so that lazy modes are charged for what they defer. It reports the
+total time, the time of each phase including this workload, and the peak RSS.
+
+Modes: eager, lazy, streamed, and cache (a warm load).
+
+Usage: python benchmarks/bench_parse.py [--sizes 10000,100000] [--modes eager,lazy]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from synthetic import Shape, make_graph, write_streamed
+
+import pybzlquery
+
+
+def data_file(data_dir: Path, size: int, streamed: bool) -> Path:
+    path = data_dir / f'aquery-{size}.{"streamed" if streamed else "pb"}'
+    if not path.exists():
+        g = make_graph(Shape(actions=size))
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            if streamed:
+                write_streamed(g, f)
+            else:
+                f.write(g.SerializeToString())
+        os.replace(tmp, path)
+    return path
+
+
+def touch(a: Any) -> int:
+    """The workload run on every action in every mode, so lazy modes pay for what they defer"""
+    return len(a.mnemonic) + sum(len(o.path) for o in a.outputs) + len(a.inputs())
+
+
+def run_child(mode: str, path: Path, cache_dir: Path) -> dict[str, object]:
+    """Parse `path` in the current process, run the workload, and return the measurements"""
+    phases: dict[str, float] = {}
+    counts: dict[str, int] = {}
+
+    def on_phase(name: str, seconds: float, count: int) -> None:
+        phases[name] = phases.get(name, 0.0) + seconds
+        counts[name] = count
+
+    start = time.perf_counter()
+    if mode == 'streamed':
+        # Parsing and the workload interleave, so each is timed around its own steps
+        n = 0
+        workload = 0.0
+        with open(path, 'rb') as f:
+            for a in pybzlquery.iter_aquery(f):
+                t = time.perf_counter()
+                touch(a)
+                workload += time.perf_counter() - t
+                n += 1
+        on_phase('parse', time.perf_counter() - start - workload, n)
+        on_phase('workload', workload, n)
+    else:
+        raw = path.read_bytes()
+        on_phase('read', time.perf_counter() - start, len(raw))
+        kwargs: dict[str, object] = {}
+        if mode in ('lazy', 'cache'):
+            kwargs['lazy'] = True
+        if mode == 'cache':
+            kwargs['cache_dir'] = cache_dir
+        actions = pybzlquery.parse_action_graph(raw, on_phase=on_phase, **kwargs).actions  # type: ignore[arg-type]
+        t = time.perf_counter()
+        for a in actions:
+            touch(a)
+        n = len(actions)
+        on_phase('workload', time.perf_counter() - t, n)
+    total = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024
+    return {'actions': n, 'total': total, 'phases': phases, 'counts': counts, 'max_rss_mb': rss_mb}
+
+
+def run(mode: str, path: Path, cache_dir: Path) -> dict[str, object]:
+    out = subprocess.check_output(
+        [sys.executable, __file__, '--child', mode, str(path), '--cache-dir', str(cache_dir)])
+    return json.loads(out)  # type: ignore[no-any-return]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000,10000000')
+    parser.add_argument('--modes', default='eager,lazy,streamed,cache')
+    parser.add_argument('--data-dir', type=Path, default=Path(tempfile.gettempdir()) / 'pybzlquery-bench')
+    parser.add_argument('--cache-dir', type=Path)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per run')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'FILE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir or args.data_dir / 'cache'
+    if args.child:
+        mode, path = args.child
+        print(json.dumps(run_child(mode, Path(path), cache_dir)))
+        return
+
+    args.data_dir.mkdir(parents=True, exist_ok=True)
+    modes = args.modes.split(',')
+    if not args.json:
+        print(f'{"actions":>10} {"mode":>10} {"total s":>9} {"max RSS MB":>10}  phases (s)')
+    for size in map(int, args.sizes.split(',')):
+        for mode in modes:
+            path = data_file(args.data_dir, size, mode == 'streamed')
+            if mode == 'cache':
+                # Fill the cache, so that the measured run is a warm load
+                run(mode, path, cache_dir)
+            r = run(mode, path, cache_dir)
+            if args.json:
+                print(json.dumps({'size': size, 'mode': mode, **r}))
+                continue
+            phases = ' '.join(f'{k}={v:.3f}' for k, v in r['phases'].items())  # type: ignore[attr-defined]
+            print(f'{size:>10} {mode:>10} {r["total"]:>9.3f} {r["max_rss_mb"]:>10.1f}  {phases}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Generate synthetic aquery output with a configurable shape.
+
+Usage: python benchmarks/synthetic.py ACTIONS OUTPUT [--streamed] [shape options]
+"""
+from __future__ import annotations
+
+import argparse
+import random
+from dataclasses import dataclass
+from typing import BinaryIO
+
+from google.protobuf.internal.encoder import _VarintBytes  # type: ignore
+
+from pybzlquery.analysis_v2_pb2 import ActionGraphContainer  # type: ignore
+
+
+@dataclass
+class Shape:
+    # Number of actions
+    actions: int = 10000
+    # Number of directories below bazel-out/k8-fastbuild/bin in artifact paths
+    path_depth: int = 4
+    # Number of children of each directory
+    dir_fanout: int = 8
+    # Number of source files per action, which are the direct artifacts of its dep set
+    direct_inputs: int = 4
+    # Number of transitive dep sets of each dep set
+    dep_set_fanout: int = 3
+    # Probability that a transitive dep set is shared with other actions, rather than a new one
+    sharing: float = 0.8
+    # Number of arguments and of environment variables of each action
+    arguments: int = 30
+    environment: int = 5
+    # Length of each argument after the first
+    argument_length: int = 16
+    # Number of actions per target
+    actions_per_target: int = 4
+    seed: int = 0
+
+
+def make_graph(shape: Shape) -> ActionGraphContainer:
+    r = random.Random(shape.seed)
+    g = ActionGraphContainer()
+    next_id = {'path_fragments': 1, 'artifacts': 1, 'dep_set_of_files': 1}
+
+    def add(field: str, **kwargs: object) -> int:
+        i = next_id[field]
+        next_id[field] += 1
+        getattr(g, field).add(id=i, **kwargs)
+        return i
+
+    root = 0
+    for label in ('bazel-out', 'k8-fastbuild', 'bin'):
+        root = add('path_fragments', label=label, parent_id=root)
+    dirs: dict[tuple[int, ...], int] = {(): root}
+
+    def directory(n: int) -> int:
+        key: tuple[int, ...] = ()
+        for level in range(shape.path_depth):
+            key = key + ((n // shape.dir_fanout ** level) % shape.dir_fanout,)
+            if key not in dirs:
+                dirs[key] = add('path_fragments', label=f'd{level}_{key[-1]}', parent_id=dirs[key[:-1]])
+        return dirs[key]
+
+    def artifact(name: str, n: int) -> int:
+        fragment = add('path_fragments', label=name, parent_id=directory(n))
+        return add('artifacts', path_fragment_id=fragment)
+
+    g.rule_classes.add(id=1, name='cc_library')
+    g.configuration.add(id=1, mnemonic='k8-fastbuild', platform_name='k8', checksum='0' * 64)
+    n_targets = max(1, -(-shape.actions // shape.actions_per_target))
+    for i in range(1, n_targets + 1):
+        g.targets.add(id=i, label=f'//pkg{i}:target', rule_class_id=1)
+
+    def argument(j: int) -> str:
+        prefix = f'-DARG{j}='
+        return prefix + 'v' * max(0, shape.argument_length - len(prefix))
+
+    dep_sets: list[int] = []
+    for i in range(shape.actions):
+        target = 1 + i // shape.actions_per_target
+        direct = [artifact(f'src{i}_{j}.cc', target) for j in range(shape.direct_inputs)]
+        transitive = set()
+        for _ in range(shape.dep_set_fanout):
+            if dep_sets and r.random() < shape.sharing:
+                transitive.add(r.choice(dep_sets))
+            else:
+                leaf = [artifact(f'hdr{i}_{len(transitive)}.h', target)]
+                transitive.add(add('dep_set_of_files', direct_artifact_ids=leaf))
+        dep_set = add('dep_set_of_files', direct_artifact_ids=direct, transitive_dep_set_ids=sorted(transitive))
+        dep_sets.append(dep_set)
+        output = artifact(f'obj{i}.o', target)
+        a = g.actions.add(
+            target_id=target, action_key=f'{i:016x}', mnemonic='CppCompile', configuration_id=1,
+            arguments=['gcc'] + [argument(j) for j in range(shape.arguments - 1)],
+            input_dep_set_ids=[dep_set], output_ids=[output], primary_output_id=output,
+            execution_platform='@local_config_platform//:host')
+        for j in range(shape.environment):
+            a.environment_variables.add(key=f'VAR{j}', value=f'value{j}')
+    return g
+
+
+def write_streamed(g: ActionGraphContainer, f: BinaryIO) -> None:
+    """Write a graph in the format of `--output=streamed_proto`, referenced entries first"""
+    for field in ('path_fragments', 'artifacts', 'rule_classes', 'targets', 'configuration',
+                  'aspect_descriptors', 'dep_set_of_files', 'actions'):
+        for x in getattr(g, field):
+            component = ActionGraphContainer()
+            getattr(component, field).add().CopyFrom(x)
+            data = component.SerializeToString()
+            f.write(_VarintBytes(len(data)))
+            f.write(data)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('actions', type=int)
+    parser.add_argument('output')
+    parser.add_argument('--streamed', action='store_true', help='write streamed_proto output')
+    for name, default in vars(Shape()).items():
+        if name != 'actions':
+            parser.add_argument('--' + name.replace('_', '-'), type=type(default), default=default)
+    args = parser.parse_args()
+    shape = Shape(**{name: getattr(args, name) for name in vars(Shape())})
+    g = make_graph(shape)
+    with open(args.output, 'wb') as f:
+        if args.streamed:
+            write_streamed(g, f)
+        else:
+            f.write(g.SerializeToString())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,17 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from subprocess import check_output
-from typing import Any
+import os
+import sys
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass, field, fields
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Iterable, Iterator, Mapping, NamedTuple, Sequence, overload
 
 from .analysis_v2_pb2 import ActionGraphContainer  # type: ignore
-# from .build_pb2 import *
 
-# def query(ws: str, target: str) -> QueryResult:
-#     output = check_output(['bazel', 'query', '--output', 'proto', target], cwd=ws)
-#     r = QueryResult()
-#     r.ParseFromString(output)
-#     return r
-
-# def cquery(ws: str, target: str) -> CqueryResult:
-#     output = check_output(['bazel', 'cquery', '--output', 'proto', target], cwd=ws)
-#     r = CqueryResult()
-#     r.ParseFromString(output)
-#     return r
-
-# def aquery(ws: str, target: str) -> ActionGraphContainer:
-#     output = check_output(['bazel', 'aquery', '--output', 'proto', target], cwd=ws)
-#     r = ActionGraphContainer()
-#     r.ParseFromString(output)
-#     return r
+if TYPE_CHECKING:
+    from typing_extensions import Literal
 
 
 @dataclass
@@ -56,6 +44,18 @@ class Configuration:
 class DepSetOfFiles:
     transitive_dep_sets: list[DepSetOfFiles]
     direct_artifacts: list[Artifact]
+    id: int = 0
+    expander: DepSetExpander | None = field(default=None, repr=False, compare=False)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # The expander references the whole graph, so pickles and copies walk the dep sets instead
+        state = self.__dict__.copy()
+        state['expander'] = None
+        return state
+
+    def flatten(self) -> list[Artifact]:
+        """Return the deduplicated artifacts of the dep set, in postorder"""
+        return _flatten_dep_sets([self])
 
 
 @dataclass
@@ -87,53 +87,707 @@ class Action:
     unresolved_symlink_target: str
     is_executable: bool
 
+    def inputs(self) -> list[Artifact]:
+        """Return the deduplicated artifacts of all input dep sets, in postorder"""
+        return _flatten_dep_sets(self.input_dep_sets)
+
+
+def get_path(path_fragment_id: int, path_fragments: dict[int, Any],
+             paths: dict[int, str] | None = None) -> str:
+    """
+    Return the path of a path fragment.
+
+    If `paths` is given, it memoizes the paths of fragments by id, so shared prefixes are
+    only resolved once. Paths are interned, so equal paths share one string object.
+    """
+    if paths is None:
+        paths = {}
+    path = paths.get(path_fragment_id)
+    if path is not None:
+        return path
+    # Walk up until a fragment with a known path, then build the paths back down
+    chain = []
+    fragment_id = path_fragment_id
+    while fragment_id != 0 and fragment_id not in paths:
+        path_fragment = path_fragments[fragment_id]
+        chain.append(path_fragment)
+        fragment_id = path_fragment.parent_id
+    prefix = paths[fragment_id] + '/' if fragment_id != 0 else ''
+    for path_fragment in reversed(chain):
+        path = sys.intern(prefix + path_fragment.label)
+        paths[path_fragment.id] = path
+        prefix = path + '/'
+    assert path is not None
+    return path
+
+
+class _DepSetEntry(NamedTuple):
+    """The fields of a DepSetOfFiles message which are needed to flatten it"""
+    id: int
+    transitive_dep_set_ids: Sequence[int]
+    direct_artifact_ids: Sequence[int]
+
+
+# The default number of flattened dep sets which are kept in memory
+DEFAULT_DEP_SET_CACHE_SIZE = 65536
+
+
+class DepSetExpander:
+    """
+    Flattens dep sets into arrays of artifact ids.
+
+    `dep_sets` maps dep set ids to DepSetOfFiles protobuf messages, and `artifacts` maps
+    artifact ids to artifacts. A dep set is flattened in postorder: the artifacts of its
+    transitive dep sets, left to right, and then its direct artifacts, keeping the first
+    occurrence of each artifact. Flattened dep sets are memoized by id as `array('I')`, in
+    an LRU cache of up to `maxsize` dep sets, so shared dep sets are flattened once.
+    """
+
+    def __init__(self, dep_sets: Mapping[int, Any], artifacts: Mapping[int, Any],
+                 maxsize: int | None = DEFAULT_DEP_SET_CACHE_SIZE):
+        self.dep_sets = dep_sets
+        self.artifacts = artifacts
+        self.maxsize = maxsize
+        self._cache: OrderedDict[int, array[int]] = OrderedDict()
+
+    def __getstate__(self) -> dict[str, Any]:
+        # The entries may be protobuf messages, which aren't picklable in this package
+        dep_sets = {i: _DepSetEntry(i, list(x.transitive_dep_set_ids), list(x.direct_artifact_ids))
+                    for i, x in self.dep_sets.items()}
+        return {'dep_sets': dep_sets, 'artifacts': dict(self.artifacts), 'maxsize': self.maxsize}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__init__(state['dep_sets'], state['artifacts'], state['maxsize'])  # type: ignore[misc]
+
+    def expand(self, dep_set_id: int) -> array[int]:
+        """Return the ids of the artifacts of a dep set, in a new array"""
+        return self._expand(dep_set_id)[:]
+
+    def expand_many(self, dep_set_ids: Iterable[int]) -> array[int]:
+        """Return the ids of the artifacts of the union of several dep sets, in a new array"""
+        return self._expand_many(dep_set_ids)[:]
+
+    def artifacts_of(self, dep_set_ids: Iterable[int]) -> list[Any]:
+        """Return the artifacts of the union of several dep sets"""
+        artifacts = self.artifacts
+        return [artifacts[i] for i in self._expand_many(dep_set_ids)]
+
+    # The arrays returned by these may be the ones in the cache, so they must not be modified
+
+    def _expand(self, dep_set_id: int) -> array[int]:
+        cache = self._cache
+        if dep_set_id in cache:
+            cache.move_to_end(dep_set_id)
+            return cache[dep_set_id]
+        # Results of this call, so that they are kept even if they are evicted from the cache
+        done: dict[int, array[int]] = {}
+        stack = [(dep_set_id, False)]
+        while stack:
+            i, children_done = stack.pop()
+            if i in done:
+                continue
+            entry = self.dep_sets[i]
+            if not children_done:
+                stack.append((i, True))
+                for child in reversed(entry.transitive_dep_set_ids):
+                    if child not in done:
+                        if child in cache:
+                            done[child] = cache[child]
+                        else:
+                            stack.append((child, False))
+                continue
+            r = _merge_ids([done[child] for child in entry.transitive_dep_set_ids] + [entry.direct_artifact_ids])
+            done[i] = r
+            self._store(i, r)
+        return done[dep_set_id]
+
+    def _expand_many(self, dep_set_ids: Iterable[int]) -> array[int]:
+        dep_set_ids = list(dep_set_ids)
+        if len(dep_set_ids) == 1:
+            return self._expand(dep_set_ids[0])
+        return _merge_ids([self._expand(i) for i in dep_set_ids])
+
+    def _store(self, dep_set_id: int, r: array[int]) -> None:
+        cache = self._cache
+        cache[dep_set_id] = r
+        if self.maxsize is not None:
+            while len(cache) > self.maxsize:
+                cache.popitem(last=False)
+
+
+def _merge_ids(parts: list[Sequence[int]]) -> array[int]:
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return array('I')
+    first = parts[0]
+    if len(parts) == 1 and isinstance(first, array):
+        return first
+    r = array('I', first)
+    seen = set(r)
+    if len(seen) != len(r):
+        r = array('I', dict.fromkeys(r))
+    for part in parts[1:]:
+        new = [i for i in part if i not in seen]
+        if new:
+            # Only direct artifacts may repeat an id within a part
+            new = list(dict.fromkeys(new))
+            seen.update(new)
+            r.extend(new)
+    return r
+
+
+def _flatten_dep_sets(dep_sets: Sequence[DepSetOfFiles]) -> list[Any]:
+    if not dep_sets:
+        return []
+    expander = dep_sets[0].expander
+    if expander is None:
+        return _walk_dep_sets(dep_sets)
+    return expander.artifacts_of(d.id for d in dep_sets)
+
+
+def _walk_dep_sets(dep_sets: Sequence[DepSetOfFiles]) -> list[Any]:
+    """Flatten dep sets without an expander, in the same order, keeping the first artifact of each path"""
+    r = []
+    seen: set[str] = set()
+    visited: set[int] = set()
+    stack = [(d, False) for d in reversed(dep_sets)]
+    while stack:
+        d, children_done = stack.pop()
+        if children_done:
+            for a in d.direct_artifacts:
+                if a.path not in seen:
+                    seen.add(a.path)
+                    r.append(a)
+            continue
+        if id(d) in visited:
+            continue
+        visited.add(id(d))
+        stack.append((d, True))
+        stack.extend((child, False) for child in reversed(d.transitive_dep_sets) if id(child) not in visited)
+    return r
+
+
+class _Missing(KeyError):
+    def __init__(self, table: _Table, key: int):
+        super().__init__(key)
+        self.table = table
+        self.key = key
+
+
+class _Table(dict):
+    """A lookup table which tells which id was missing, so streaming can wait for it"""
+
+    def __missing__(self, key: int) -> Any:
+        raise _Missing(self, key)
+
+
+class _Tables:
+    """The id lookup tables of an action graph, and the code which converts entries into objects"""
+
+    def __init__(self, table: type = dict, dep_set_cache_size: int | None = DEFAULT_DEP_SET_CACHE_SIZE):
+        self.dep_set_cache_size = dep_set_cache_size
+        self.path_fragments: dict[int, Any] = table()
+        self.paths: dict[int, str] = {}
+        self.artifacts: dict[int, Artifact] = table()
+        self.rule_classes: dict[int, str] = table()
+        self.targets: dict[int, Target] = table()
+        self.aspect_descriptors: dict[int, AspectDescriptor] = table()
+        self.configurations: dict[int, Configuration] = table()
+        self.dep_sets: dict[int, DepSetOfFiles] = table()
+        self.dep_set_entries: Mapping[int, Any] = table()
+        self.expander = DepSetExpander(self.dep_set_entries, self.artifacts, dep_set_cache_size)
+
+    def make_artifact(self, x: Any) -> Artifact:
+        return Artifact(get_path(x.path_fragment_id, self.path_fragments, self.paths), x.is_tree_artifact)
+
+    def make_target(self, x: Any) -> Target:
+        return Target(x.label, self.rule_classes[x.rule_class_id])
+
+    def make_aspect_descriptor(self, x: Any) -> AspectDescriptor:
+        return AspectDescriptor(x.name, {p.key: p.value for p in x.parameters})
+
+    def make_configuration(self, x: Any) -> Configuration:
+        return Configuration(x.mnemonic, x.platform_name, x.checksum, x.is_tool)
+
+    def make_dep_set(self, x: Any) -> DepSetOfFiles:
+        return DepSetOfFiles([self.dep_sets[i] for i in x.transitive_dep_set_ids],
+                             [self.artifacts[i] for i in x.direct_artifact_ids], x.id, self.expander)
+
+    def make_action(self, a: Any) -> Action:
+        return Action(
+            target=self.targets[a.target_id],
+            aspect_descriptors=[self.aspect_descriptors[i] for i in a.aspect_descriptor_ids],
+            action_key=a.action_key,
+            mnemonic=a.mnemonic,
+            configuration=self.configurations[a.configuration_id],
+            arguments=list(a.arguments),
+            environment_variables={p.key: p.value for p in a.environment_variables},
+            input_dep_sets=[self.dep_sets[i] for i in a.input_dep_set_ids],
+            scheduling_dep_dep_sets=[self.dep_sets[i] for i in a.scheduling_dep_dep_set_ids] if hasattr(a, 'scheduling_dep_dep_set_ids') else None,
+            outputs=[self.artifacts[i] for i in a.output_ids],
+            discovers_inputs=a.discovers_inputs,
+            execution_info={p.key: p.value for p in a.execution_info},
+            param_files=[ParamFile(p.exec_path, list(p.arguments)) for p in a.param_files],
+            primary_output=self.artifacts[a.primary_output_id],
+            execution_platform=a.execution_platform,
+            template_content=a.template_content,
+            substitutions={p.key: p.value for p in a.substitutions},
+            file_contents=a.file_contents,
+            unresolved_symlink_target=a.unresolved_symlink_target,
+            is_executable=a.is_executable,
+        )
+
+
+class _cached:
+    """
+    A property of a `__slots__` view which is computed on first access.
+
+    The value is cached in the slot named like the property with a leading underscore.
+    """
+
+    def __init__(self, compute: Callable[[Any], Any]):
+        self.compute = compute
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.slot = owner.__dict__['_' + name]
+
+    def __get__(self, obj: Any, owner: type | None = None) -> Any:
+        if obj is None:
+            return self
+        try:
+            return self.slot.__get__(obj, owner)
+        except AttributeError:
+            value = self.compute(obj)
+            self.slot.__set__(obj, value)
+            return value
+
+
+class _View:
+    """
+    A lazy view over a protobuf message, with the same attributes as a dataclass.
+
+    Unlike the dataclasses, views compare by identity, and views of aquery output can't be
+    pickled, since they reference the protobuf messages and the tables of the whole graph.
+    """
+    __slots__ = ('_msg', '_t')
+    _fields: tuple[str, ...] = ()
+
+    def __init__(self, msg: Any, t: Any):
+        self._msg = msg
+        self._t = t
+
+    def __repr__(self) -> str:
+        args = ', '.join(f'{name}={getattr(self, name)!r}' for name in self._fields)
+        return f'{type(self).__name__}({args})'
+
+
+def _view_slots(cls: type) -> tuple[str, ...]:
+    return tuple('_' + f.name for f in fields(cls))
+
+
+class ArtifactView(_View):
+    __slots__ = _view_slots(Artifact)
+    _fields = tuple(f.name for f in fields(Artifact))
+
+    path = _cached(lambda self: get_path(self._msg.path_fragment_id, self._t.path_fragments, self._t.paths))
+    is_tree_artifact = _cached(lambda self: self._msg.is_tree_artifact)
+
+
+class TargetView(_View):
+    __slots__ = _view_slots(Target)
+    _fields = tuple(f.name for f in fields(Target))
+
+    label = _cached(lambda self: self._msg.label)
+    rule_class = _cached(lambda self: self._t.rule_classes[self._msg.rule_class_id])
+
+
+class ConfigurationView(_View):
+    __slots__ = _view_slots(Configuration)
+    _fields = tuple(f.name for f in fields(Configuration))
+
+    mnemonic = _cached(lambda self: self._msg.mnemonic)
+    platform_name = _cached(lambda self: self._msg.platform_name)
+    checksum = _cached(lambda self: self._msg.checksum)
+    is_tool = _cached(lambda self: self._msg.is_tool)
+
+
+class DepSetOfFilesView(_View):
+    __slots__ = _view_slots(DepSetOfFiles)
+    _fields = ('transitive_dep_sets', 'direct_artifacts', 'id')
 
-def get_path(path_fragment_id: int, path_fragments: dict[int, Any]) -> str:
-    path_fragment = path_fragments[path_fragment_id]
-    if path_fragment.parent_id != 0:
-        return get_path(path_fragment.parent_id, path_fragments) + '/' + path_fragment.label
-    else:
-        return path_fragment.label
+    transitive_dep_sets = _cached(lambda self: [self._t.dep_sets[i] for i in self._msg.transitive_dep_set_ids])
+    direct_artifacts = _cached(lambda self: [self._t.artifacts[i] for i in self._msg.direct_artifact_ids])
+    id = _cached(lambda self: self._msg.id)
+    expander = _cached(lambda self: self._t.expander)
 
+    def flatten(self) -> list[ArtifactView]:
+        """Return the deduplicated artifacts of the dep set, in postorder"""
+        return self._t.expander.artifacts_of([self._msg.id])
 
-def parse_aquery(raw: bytes) -> list[Action]:
+
+class ActionView(_View):
+    __slots__ = _view_slots(Action)
+    _fields = tuple(f.name for f in fields(Action))
+
+    target = _cached(lambda self: self._t.targets[self._msg.target_id])
+    aspect_descriptors = _cached(lambda self: [self._t.aspect_descriptors[i] for i in self._msg.aspect_descriptor_ids])
+    action_key = _cached(lambda self: self._msg.action_key)
+    mnemonic = _cached(lambda self: self._msg.mnemonic)
+    configuration = _cached(lambda self: self._t.configurations[self._msg.configuration_id])
+    arguments = _cached(lambda self: list(self._msg.arguments))
+    environment_variables = _cached(lambda self: {p.key: p.value for p in self._msg.environment_variables})
+    input_dep_sets = _cached(lambda self: [self._t.dep_sets[i] for i in self._msg.input_dep_set_ids])
+    scheduling_dep_dep_sets = _cached(
+        lambda self: [self._t.dep_sets[i] for i in self._msg.scheduling_dep_dep_set_ids]
+        if hasattr(self._msg, 'scheduling_dep_dep_set_ids') else None)
+    outputs = _cached(lambda self: [self._t.artifacts[i] for i in self._msg.output_ids])
+    discovers_inputs = _cached(lambda self: self._msg.discovers_inputs)
+    execution_info = _cached(lambda self: {p.key: p.value for p in self._msg.execution_info})
+    param_files = _cached(lambda self: [ParamFile(p.exec_path, list(p.arguments)) for p in self._msg.param_files])
+    primary_output = _cached(lambda self: self._t.artifacts[self._msg.primary_output_id])
+    execution_platform = _cached(lambda self: self._msg.execution_platform)
+    template_content = _cached(lambda self: self._msg.template_content)
+    substitutions = _cached(lambda self: {p.key: p.value for p in self._msg.substitutions})
+    file_contents = _cached(lambda self: self._msg.file_contents)
+    unresolved_symlink_target = _cached(lambda self: self._msg.unresolved_symlink_target)
+    is_executable = _cached(lambda self: self._msg.is_executable)
+
+    def inputs(self) -> list[ArtifactView]:
+        """Return the deduplicated artifacts of all input dep sets, in postorder"""
+        return self._t.expander.artifacts_of(self._msg.input_dep_set_ids)
+
+
+def _by_id(entries: Iterable[Any]) -> dict[int, Any]:
+    return {x.id: x for x in entries}
+
+
+class _LazyTable(dict):
+    """A lookup table which converts protobuf entries into objects on first lookup"""
+
+    def __init__(self, entries: Mapping[int, Any], make: Callable[[Any], Any]):
+        super().__init__()
+        self.entries = entries
+        self.make = make
+
+    def __missing__(self, key: int) -> Any:
+        value = self[key] = self.make(self.entries[key])
+        return value
+
+
+class _LazyTables(_Tables):
+    """Lookup tables which create views and convert entries only when they are looked up"""
+
+    def __init__(self, aquery: Any, dep_set_cache_size: int | None = DEFAULT_DEP_SET_CACHE_SIZE):
+        super().__init__(dep_set_cache_size=dep_set_cache_size)
+        self.path_fragments = {x.id: x for x in aquery.path_fragments}
+        self.artifacts = _LazyTable(_by_id(aquery.artifacts), self.make_artifact)
+        self.rule_classes = {x.id: x.name for x in aquery.rule_classes}
+        self.targets = _LazyTable(_by_id(aquery.targets), self.make_target)
+        self.aspect_descriptors = _LazyTable(_by_id(aquery.aspect_descriptors), self.make_aspect_descriptor)
+        self.configurations = _LazyTable(_by_id(aquery.configuration), self.make_configuration)
+        self.dep_sets = _LazyTable(_by_id(aquery.dep_set_of_files), self.make_dep_set)
+        self.dep_set_entries = self.dep_sets.entries
+        self.expander = DepSetExpander(self.dep_set_entries, self.artifacts, dep_set_cache_size)
+
+    def make_artifact(self, x: Any) -> ArtifactView:  # type: ignore[override]
+        return ArtifactView(x, self)
+
+    def make_target(self, x: Any) -> TargetView:  # type: ignore[override]
+        return TargetView(x, self)
+
+    def make_configuration(self, x: Any) -> ConfigurationView:  # type: ignore[override]
+        return ConfigurationView(x, self)
+
+    def make_dep_set(self, x: Any) -> DepSetOfFilesView:  # type: ignore[override]
+        return DepSetOfFilesView(x, self)
+
+    def make_action(self, a: Any) -> ActionView:  # type: ignore[override]
+        return ActionView(a, self)
+
+
+# Called with the name of a phase of parsing, its duration in seconds, and the number of objects
+PhaseCallback = Callable[[str, float, int], None]
+
+
+class _PhaseTimer:
+    """Reports the duration of each phase since the previous one to a PhaseCallback"""
+
+    def __init__(self, callback: PhaseCallback | None):
+        self.callback = callback
+        self.start = perf_counter()
+
+    def __call__(self, name: str, count: int) -> None:
+        if self.callback is not None:
+            now = perf_counter()
+            self.callback(name, now - self.start, count)
+            self.start = now
+
+
+class ActionGraph:
+    """
+    The parsed output of aquery: the actions, and the lookup tables they were built from.
+
+    The indexes used by the lookup methods are built on first use.
+    """
+
+    def __init__(self, actions: Sequence[Any], t: _Tables):
+        self.actions = actions
+        self._t = t
+        self._by_output: dict[str, Any] | None = None
+        self._by_label: dict[str, list[Any]] | None = None
+        self._by_mnemonic: dict[str, list[Any]] | None = None
+        self._by_input: dict[int, list[Any]] | None = None
+        self._artifact_ids: dict[str, int] | None = None
+
+    @property
+    def artifacts(self) -> dict[int, Any]:
+        return self._t.artifacts
+
+    @property
+    def targets(self) -> dict[int, Any]:
+        return self._t.targets
+
+    @property
+    def dep_sets(self) -> dict[int, Any]:
+        return self._t.dep_sets
+
+    @property
+    def expander(self) -> DepSetExpander:
+        return self._t.expander
+
+    def __len__(self) -> int:
+        return len(self.actions)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.actions)
+
+    def producing_action(self, path: str) -> Any | None:
+        """Return the action which outputs the given path, or None"""
+        if self._by_output is None:
+            self._by_output = {o.path: a for a in self.actions for o in a.outputs}
+        return self._by_output.get(path)
+
+    def actions_of_label(self, label: str) -> list[Any]:
+        """Return the actions of the target with the given label"""
+        if self._by_label is None:
+            self._by_label = _group_by(self.actions, lambda a: a.target.label)
+        return self._by_label.get(label, [])
+
+    def actions_with_mnemonic(self, mnemonic: str) -> list[Any]:
+        """Return the actions with the given mnemonic"""
+        if self._by_mnemonic is None:
+            self._by_mnemonic = _group_by(self.actions, lambda a: a.mnemonic)
+        return self._by_mnemonic.get(mnemonic, [])
+
+    def consuming_actions(self, path: str) -> list[Any]:
+        """Return the actions which have the given path among their flattened inputs"""
+        if self._artifact_ids is None:
+            artifacts = self._t.artifacts
+            ids = artifacts.entries if isinstance(artifacts, _LazyTable) else artifacts
+            self._artifact_ids = {artifacts[i].path: i for i in ids}
+        if self._by_input is None:
+            by_input: dict[int, list[Any]] = {}
+            expander = self._t.expander
+            for a in self.actions:
+                for i in expander._expand_many(_input_dep_set_ids(a)):
+                    by_input.setdefault(i, []).append(a)
+            self._by_input = by_input
+        artifact_id = self._artifact_ids.get(path)
+        if artifact_id is None:
+            return []
+        return self._by_input.get(artifact_id, [])
+
+
+def _input_dep_set_ids(a: Any) -> Sequence[int]:
+    if isinstance(a, ActionView):
+        return a._msg.input_dep_set_ids  # type: ignore[no-any-return]
+    return [d.id for d in a.input_dep_sets]
+
+
+def _group_by(actions: Iterable[Any], key: Callable[[Any], str]) -> dict[str, list[Any]]:
+    r: dict[str, list[Any]] = {}
+    for a in actions:
+        r.setdefault(key(a), []).append(a)
+    return r
+
+
+def parse_action_graph(raw: bytes, lazy: bool = False, cache_dir: str | os.PathLike[str] | None = None,
+                       max_cache_size: int | None = 8 << 30, on_phase: PhaseCallback | None = None,
+                       dep_set_cache_size: int | None = DEFAULT_DEP_SET_CACHE_SIZE) -> ActionGraph:
+    """
+    Parse the output of `bazel aquery --output=proto` into an indexed ActionGraph.
+
+    If `cache_dir` is given, the resolved graph is stored there in a memory-mapped file keyed
+    by a hash of `raw`, and later calls with the same output load it from there instead of
+    parsing it again. Cached graphs are loaded as views, so `cache_dir` requires `lazy=True`.
+    The least recently used files are removed when the cache grows beyond `max_cache_size` bytes.
+
+    If `on_phase` is given, it is called after each phase of parsing with the name of the
+    phase, its duration in seconds, and the number of objects it produced. The phases are
+    'decode', 'paths', 'tables', 'dep_sets' and 'actions'; with a cache, they are 'hash',
+    'decode' and 'write' on a miss, and 'load'.
+
+    The artifacts of flattened dep sets are memoized for up to `dep_set_cache_size` dep sets,
+    or without a bound if it is None, so that dep sets shared by many actions are flattened once.
+    """
+    if cache_dir is not None:
+        if not lazy:
+            raise ValueError('cache_dir requires lazy=True, since cached graphs are loaded as views')
+        from ._cache import parse_cached
+        return parse_cached(raw, cache_dir, max_cache_size, on_phase, dep_set_cache_size)
+
+    phase = _PhaseTimer(on_phase)
     aquery = ActionGraphContainer()
     aquery.ParseFromString(raw)
+    phase('decode', len(aquery.actions))
 
-    path_fragments = {x.id: x for x in aquery.path_fragments}
-    artifacts = {x.id: Artifact(get_path(x.path_fragment_id, path_fragments), x.is_tree_artifact)
-                 for x in aquery.artifacts}
-    rule_classes = {x.id: x.name for x in aquery.rule_classes}
-    targets = {x.id: Target(x.label, rule_classes[x.rule_class_id]) for x in aquery.targets}
-    aspect_descriptors = {x.id: AspectDescriptor(x.name, {p.key: p.value for p in x.parameters})
-                          for x in aquery.aspect_descriptors}
-    configurations = {x.id: Configuration(x.mnemonic, x.platform_name, x.checksum, x.is_tool)
-                      for x in aquery.configuration}
-    dep_sets = {}
+    if lazy:
+        lt = _LazyTables(aquery, dep_set_cache_size)
+        phase('tables', len(aquery.artifacts) + len(aquery.dep_set_of_files))
+        actions: list[Any] = [lt.make_action(a) for a in aquery.actions]
+        phase('actions', len(actions))
+        return ActionGraph(actions, lt)
+
+    t = _Tables(dep_set_cache_size=dep_set_cache_size)
+    t.path_fragments = {x.id: x for x in aquery.path_fragments}
+    t.artifacts = {x.id: t.make_artifact(x) for x in aquery.artifacts}
+    phase('paths', len(t.artifacts))
+    t.rule_classes = {x.id: x.name for x in aquery.rule_classes}
+    t.targets = {x.id: t.make_target(x) for x in aquery.targets}
+    t.aspect_descriptors = {x.id: t.make_aspect_descriptor(x) for x in aquery.aspect_descriptors}
+    t.configurations = {x.id: t.make_configuration(x) for x in aquery.configuration}
+    phase('tables', len(t.targets) + len(t.aspect_descriptors) + len(t.configurations))
+    t.dep_set_entries = _by_id(aquery.dep_set_of_files)
+    t.expander = DepSetExpander(t.dep_set_entries, t.artifacts, dep_set_cache_size)
     for dep_set in aquery.dep_set_of_files:
-        dep_sets[dep_set.id] = DepSetOfFiles([dep_sets[i] for i in dep_set.transitive_dep_set_ids], [
-                                             artifacts[i] for i in dep_set.direct_artifact_ids])
-    actions = [Action(
-        target=targets[a.target_id],
-        aspect_descriptors=[aspect_descriptors[i] for i in a.aspect_descriptor_ids],
-        action_key=a.action_key,
-        mnemonic=a.mnemonic,
-        configuration=configurations[a.configuration_id],
-        arguments=list(a.arguments),
-        environment_variables={p.key: p.value for p in a.environment_variables},
-        input_dep_sets=[dep_sets[i] for i in a.input_dep_set_ids],
-        scheduling_dep_dep_sets=[dep_sets[i] for i in a.scheduling_dep_dep_set_ids] if hasattr(a, 'scheduling_dep_dep_set_ids') else None,
-        outputs=[artifacts[i] for i in a.output_ids],
-        discovers_inputs=a.discovers_inputs,
-        execution_info={p.key: p.value for p in a.execution_info},
-        param_files=[ParamFile(p.exec_path, p.arguments) for p in a.param_files],
-        primary_output=artifacts[a.primary_output_id],
-        execution_platform=a.execution_platform,
-        template_content=a.template_content,
-        substitutions={p.key: p.value for p in a.substitutions},
-        file_contents=a.file_contents,
-        unresolved_symlink_target=a.unresolved_symlink_target,
-        is_executable=a.is_executable,
-    ) for a in aquery.actions]
-
-    return actions
+        t.dep_sets[dep_set.id] = t.make_dep_set(dep_set)
+    phase('dep_sets', len(t.dep_sets))
+    actions = [t.make_action(a) for a in aquery.actions]
+    phase('actions', len(actions))
+
+    return ActionGraph(actions, t)
+
+
+@overload
+def parse_aquery(raw: bytes, lazy: Literal[False] = False, cache_dir: None = None,
+                 max_cache_size: int | None = 8 << 30, on_phase: PhaseCallback | None = None,
+                 dep_set_cache_size: int | None = DEFAULT_DEP_SET_CACHE_SIZE) -> list[Action]: ...
+
+
+@overload
+def parse_aquery(raw: bytes, lazy: Literal[True], cache_dir: str | os.PathLike[str] | None = None,
+                 max_cache_size: int | None = 8 << 30, on_phase: PhaseCallback | None = None,
+                 dep_set_cache_size: int | None = DEFAULT_DEP_SET_CACHE_SIZE) -> Sequence[ActionView]: ...
+
+
+@overload
+def parse_aquery(raw: bytes, lazy: bool = False, cache_dir: str | os.PathLike[str] | None = None,
+                 max_cache_size: int | None = 8 << 30, on_phase: PhaseCallback | None = None,
+                 dep_set_cache_size: int | None = DEFAULT_DEP_SET_CACHE_SIZE,
+                 ) -> list[Action] | Sequence[ActionView]: ...
+
+
+def parse_aquery(raw: bytes, lazy: bool = False, cache_dir: str | os.PathLike[str] | None = None,
+                 max_cache_size: int | None = 8 << 30, on_phase: PhaseCallback | None = None,
+                 dep_set_cache_size: int | None = DEFAULT_DEP_SET_CACHE_SIZE,
+                 ) -> list[Action] | Sequence[ActionView]:
+    """
+    Parse the output of `bazel aquery --output=proto`.
+
+    If `lazy` is true, return ActionViews, which have the same attributes as Actions but
+    convert each field of the underlying protobuf message only on first access. Targets,
+    artifacts, configurations and dep sets are then views as well, so the dep sets of an
+    action are only built one level at a time, as they are accessed. Unlike Actions, views
+    compare by identity and can't be pickled.
+
+    If `cache_dir` is given, `lazy` must be true, and the ActionViews are returned as a
+    read-only sequence which parses each action from the cache file on first access, rather
+    than as a list. See `parse_action_graph` for `cache_dir`, `max_cache_size`,
+    `on_phase` and `dep_set_cache_size`.
+    """
+    return parse_action_graph(raw, lazy, cache_dir, max_cache_size, on_phase, dep_set_cache_size).actions
+
+
+def _read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    while len(data) < size:
+        more = f.read(size - len(data))
+        if not more:
+            raise ValueError('Truncated message in delimited stream')
+        data += more
+    return data
+
+
+def _iter_delimited(f: BinaryIO) -> Iterator[bytes]:
+    """Yield the messages of a stream of varint-length-delimited protobuf messages"""
+    while True:
+        size = 0
+        shift = 0
+        while True:
+            b = f.read(1)
+            if not b:
+                if shift == 0:
+                    return
+                raise ValueError('Truncated length in delimited stream')
+            size |= (b[0] & 0x7f) << shift
+            if b[0] < 0x80:
+                break
+            shift += 7
+        yield _read_exact(f, size)
+
+
+def iter_aquery(f: BinaryIO) -> Iterator[Action]:
+    """
+    Parse the output of `bazel aquery --output=streamed_proto` incrementally.
+
+    Each Action is yielded as soon as everything it references has been read, so memory
+    is bounded by the lookup tables rather than by the number of actions.
+    """
+    # Each ActionGraphComponent holds one entry in a oneof whose field numbers are the same
+    # as those of the repeated fields of ActionGraphContainer, so a component parses as a
+    # container with a single entry.
+    t = _Tables(_Table)
+    dep_set_entries: dict[int, Any] = {}
+    t.dep_set_entries = dep_set_entries
+    t.expander = DepSetExpander(dep_set_entries, t.artifacts, t.dep_set_cache_size)
+    builders: dict[str, tuple[Callable[[Any], Any], dict[int, Any] | None]] = {
+        'path_fragments': (lambda x: x, t.path_fragments),
+        'artifacts': (t.make_artifact, t.artifacts),
+        'rule_classes': (lambda x: x.name, t.rule_classes),
+        'targets': (t.make_target, t.targets),
+        'aspect_descriptors': (t.make_aspect_descriptor, t.aspect_descriptors),
+        'configuration': (t.make_configuration, t.configurations),
+        'dep_set_of_files': (t.make_dep_set, t.dep_sets),
+        'actions': (t.make_action, None),
+    }
+    # Entries which reference an id which wasn't read yet, by (table, id)
+    waiting: dict[tuple[int, int], list[tuple[str, Any]]] = {}
+    for raw in _iter_delimited(f):
+        component = ActionGraphContainer()
+        component.ParseFromString(raw)
+        for descriptor, values in component.ListFields():
+            queue = [(descriptor.name, x) for x in reversed(values)]
+            while queue:
+                kind, x = queue.pop()
+                make, table = builders[kind]
+                try:
+                    obj = make(x)
+                except _Missing as e:
+                    waiting.setdefault((id(e.table), e.key), []).append((kind, x))
+                    continue
+                if table is None:
+                    yield obj
+                else:
+                    table[x.id] = obj
+                    if table is t.dep_sets:
+                        dep_set_entries[x.id] = x
+                    queue.extend(reversed(waiting.pop((id(table), x.id), [])))
+    if waiting:
+        _, key = next(iter(waiting))
+        raise ValueError(f'aquery stream references {len(waiting)} missing entries, for example id {key}')
+
+
+from ._query import (Attributes, ConfiguredTarget, QueryTarget, Rule, decode_attribute, iter_cquery,  # noqa: E402
+                     iter_query, parse_cquery, parse_query)
+from ._bazel import Bazel, git_workspace_state  # noqa: E402
+from ._diff import ActionDiff, diff_aquery  # noqa: E402
@@ -0,0 +1,278 @@
+"""
+Running Bazel queries and parsing their output while it is produced.
+
+Bazel writes `--output=streamed_proto` to a pipe, which is parsed incrementally, so the
+output is never held in memory as a whole. Queries can run concurrently in a process pool,
+identical queries which are in flight are coalesced, and results can be cached on disk,
+keyed by the command line and by the state of the workspace.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from pathlib import Path
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, check_output
+from typing import Any, BinaryIO, Callable, Iterator, Sequence, cast
+
+from google.protobuf.message import DecodeError  # type: ignore
+
+from . import Artifact, DepSetExpander, _DepSetEntry, iter_aquery, iter_cquery, iter_query
+from ._cache import evict
+
+SUFFIX = '.streamed'
+
+_PARSERS: dict[str, Callable[[BinaryIO], Iterator[Any]]] = {
+    'aquery': iter_aquery,
+    'query': iter_query,
+    'cquery': iter_cquery,
+}
+
+
+def git_workspace_state(workspace: str | os.PathLike[str]) -> str | None:
+    """
+    Return a hash of the state of a git workspace, or None if it isn't a git workspace.
+
+    The hash covers the HEAD commit, the uncommitted changes to tracked files, and the names,
+    sizes and modification times of untracked files which aren't ignored.
+    """
+    try:
+        head = check_output(['git', 'rev-parse', 'HEAD'], cwd=workspace, stderr=DEVNULL)
+        diff = check_output(['git', 'diff', 'HEAD', '--binary'], cwd=workspace, stderr=DEVNULL)
+        untracked = check_output(['git', 'ls-files', '--others', '--exclude-standard', '-z'],
+                                 cwd=workspace, stderr=DEVNULL)
+    except (OSError, CalledProcessError):
+        return None
+    h = hashlib.sha256(head)
+    h.update(hashlib.sha256(diff).digest())
+    for name in untracked.split(b'\0'):
+        if not name:
+            continue
+        try:
+            st = os.stat(os.path.join(os.fsencode(workspace), name))
+        except OSError:
+            continue
+        h.update(b'%s\0%d\0%d\0' % (name, st.st_size, st.st_mtime_ns))
+    return h.hexdigest()
+
+
+class Bazel:
+    """
+    Runs queries in a Bazel workspace.
+
+    `aquery`, `query` and `cquery` run a query and return the parsed results. `submit` runs a
+    query in a pool of `max_workers` processes and returns a future, and the `*_async`
+    methods await it. Identical queries which are in flight share one run.
+
+    If `cache_dir` is given, the output of each query is stored there, keyed by the command
+    line and by `workspace_state(workspace)`, and reused while the state is the same. Results
+    are not cached if `workspace_state` returns None. The least recently used outputs are
+    removed when the cache grows beyond `max_cache_size` bytes.
+
+    Note that a Bazel server runs one command at a time, so concurrent queries in the same
+    output base only overlap in parsing.
+    """
+
+    def __init__(self, workspace: str | os.PathLike[str] = '.', bazel: str = 'bazel',
+                 startup_options: Sequence[str] = (), cache_dir: str | os.PathLike[str] | None = None,
+                 workspace_state: Callable[[str | os.PathLike[str]], str | None] = git_workspace_state,
+                 max_cache_size: int | None = 8 << 30, max_workers: int | None = None):
+        self.workspace = workspace
+        self.bazel = bazel
+        self.startup_options = list(startup_options)
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.workspace_state = workspace_state
+        self.max_cache_size = max_cache_size
+        self.max_workers = max_workers
+        self._executor: Executor | None = None
+        self._in_flight: dict[str, Future[list[Any]]] = {}
+        self._lock = threading.Lock()
+
+    def argv(self, command: str, expression: str, options: Sequence[str] = ()) -> list[str]:
+        return [self.bazel, *self.startup_options, command, '--output=streamed_proto', *options, expression]
+
+    def run(self, command: str, expression: str, options: Sequence[str] = ()) -> list[Any]:
+        """Run a query, one of 'aquery', 'query' or 'cquery', and return the parsed results"""
+        argv = self.argv(command, expression, options)
+        return _run(argv, self.workspace, command, self._cache_path(argv), self.max_cache_size)
+
+    def aquery(self, expression: str, *options: str) -> list[Any]:
+        return self.run('aquery', expression, options)
+
+    def query(self, expression: str, *options: str) -> list[Any]:
+        return self.run('query', expression, options)
+
+    def cquery(self, expression: str, *options: str) -> list[Any]:
+        return self.run('cquery', expression, options)
+
+    def submit(self, command: str, expression: str, options: Sequence[str] = ()) -> Future[list[Any]]:
+        """Run a query in the process pool, or join an identical query which is in flight"""
+        argv = self.argv(command, expression, options)
+        return self._submit(command, argv, self._cache_path(argv))
+
+    async def run_async(self, command: str, expression: str, options: Sequence[str] = ()) -> list[Any]:
+        argv = self.argv(command, expression, options)
+        # The workspace state runs git, so it is computed off the event loop
+        cache_path = await asyncio.get_running_loop().run_in_executor(None, self._cache_path, argv)
+        return await asyncio.wrap_future(self._submit(command, argv, cache_path))
+
+    async def aquery_async(self, expression: str, *options: str) -> list[Any]:
+        return await self.run_async('aquery', expression, options)
+
+    async def query_async(self, expression: str, *options: str) -> list[Any]:
+        return await self.run_async('query', expression, options)
+
+    async def cquery_async(self, expression: str, *options: str) -> list[Any]:
+        return await self.run_async('cquery', expression, options)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> Bazel:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def _submit(self, command: str, argv: list[str], cache_path: Path | None) -> Future[list[Any]]:
+        key = json.dumps([argv, str(cache_path)])
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.max_workers)
+            pooled = self._executor.submit(_run, argv, self.workspace, command, cache_path, self.max_cache_size)
+            future = _then(pooled, _with_expander) if command == 'aquery' else pooled
+            self._in_flight[key] = future
+        future.add_done_callback(lambda _: self._done(key))
+        return future
+
+    def _done(self, key: str) -> None:
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def _cache_path(self, argv: list[str]) -> Path | None:
+        if self.cache_dir is None:
+            return None
+        state = self.workspace_state(self.workspace)
+        if state is None:
+            return None
+        key = hashlib.sha256(json.dumps([argv, os.fspath(self.workspace), state]).encode()).hexdigest()
+        return self.cache_dir / (key + SUFFIX)
+
+
+def _then(future: Future[Any], convert: Callable[[Any], Any]) -> Future[Any]:
+    """Return a future of the result of `future` passed through `convert`"""
+    r: Future[Any] = Future()
+
+    def done(f: Future[Any]) -> None:
+        if not r.set_running_or_notify_cancel():
+            return
+        try:
+            r.set_result(convert(f.result()))
+        except BaseException as e:
+            r.set_exception(e)
+
+    future.add_done_callback(done)
+    return r
+
+
+def _with_expander(actions: list[Any]) -> list[Any]:
+    """
+    Give the dep sets of Actions returned by the process pool an expander again.
+
+    Pickling drops the expanders of dep sets, so without this `inputs()` would walk them every
+    time. The artifacts are numbered by identity, which pickling preserves within one result.
+    """
+    dep_sets: dict[int, _DepSetEntry] = {}
+    artifacts: dict[int, Artifact] = {}
+    artifact_ids: dict[int, int] = {}
+    expander = DepSetExpander(dep_sets, artifacts)
+    stack = [d for a in actions for d in a.input_dep_sets + (a.scheduling_dep_dep_sets or [])]
+    while stack:
+        d = stack.pop()
+        if d.expander is not None:
+            continue
+        d.expander = expander
+        direct = []
+        for x in d.direct_artifacts:
+            i = artifact_ids.get(id(x))
+            if i is None:
+                i = artifact_ids[id(x)] = len(artifacts) + 1
+                artifacts[i] = x
+            direct.append(i)
+        dep_sets[d.id] = _DepSetEntry(d.id, [c.id for c in d.transitive_dep_sets], direct)
+        stack.extend(d.transitive_dep_sets)
+    return actions
+
+
+class _Tee:
+    """A file which copies what is read from another file into a third one"""
+
+    def __init__(self, f: BinaryIO, out: BinaryIO):
+        self.f = f
+        self.out = out
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.f.read(size)
+        self.out.write(data)
+        return data
+
+
+def _parse_output(proc: Popen[bytes], argv: list[str], parse: Callable[[BinaryIO], Iterator[Any]],
+                  f: BinaryIO) -> list[Any]:
+    with proc:
+        try:
+            r = list(parse(f))
+        except ValueError:
+            # Truncated output is reported as the failure of bazel, if it failed
+            if proc.wait() != 0:
+                raise CalledProcessError(proc.returncode, argv)
+            raise
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, argv)
+    return r
+
+
+def _run(argv: list[str], workspace: str | os.PathLike[str], command: str, cache_path: Path | None,
+         max_cache_size: int | None) -> list[Any]:
+    parse = _PARSERS[command]
+    if cache_path is not None:
+        try:
+            with open(cache_path, 'rb') as f:
+                r = list(parse(f))
+            os.utime(cache_path)
+            return r
+        except FileNotFoundError:
+            pass
+        except (ValueError, DecodeError):
+            # A truncated or corrupt output is a miss, and is replaced
+            try:
+                os.unlink(cache_path)
+            except OSError:
+                pass
+
+    proc = Popen(argv, cwd=workspace, stdout=PIPE)
+    assert proc.stdout is not None
+    if cache_path is None:
+        return _parse_output(proc, argv, parse, cast(BinaryIO, proc.stdout))
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_path.parent, prefix='.tmp-', suffix=SUFFIX)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            r = _parse_output(proc, argv, parse, _Tee(proc.stdout, out))  # type: ignore[arg-type]
+        os.replace(tmp, cache_path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    if max_cache_size is not None:
+        evict(cache_path.parent, max_cache_size, keep=cache_path, suffix=SUFFIX)
+    return r
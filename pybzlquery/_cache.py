@@ -0,0 +1,297 @@
+"""
+An on-disk cache of parsed action graphs.
+
+A cache file holds a resolved action graph in a columnar format, which is memory-mapped
+when loaded: artifact paths are stored as one string table with offsets, dep sets as arrays
+of ids with offsets, and actions as their serialized protobuf messages with offsets. Loading
+only parses the small tables (targets, configurations, aspects), so it takes about the same
+time regardless of the size of the graph, and processes loading the same file share its pages.
+"""
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import Any, Iterator, Mapping, Sequence
+
+from . import (DEFAULT_DEP_SET_CACHE_SIZE, ActionGraph, ActionView, Artifact, DepSetExpander, PhaseCallback,
+               _DepSetEntry, _LazyTable, _LazyTables, _PhaseTimer, get_path)
+from google.protobuf.message import DecodeError  # type: ignore
+
+from .analysis_v2_pb2 import Action as ActionProto  # type: ignore
+from .analysis_v2_pb2 import ActionGraphContainer  # type: ignore
+from .analysis_v2_pb2 import DESCRIPTOR  # type: ignore
+
+# Bump when the layout of cache files changes
+FORMAT_VERSION = 1
+SUFFIX = '.pbzq'
+DEFAULT_MAX_SIZE = 8 << 30
+
+_MAGIC = b'PBZQGRPH'
+_HEADER = struct.Struct('<8sII')
+_SECTION = struct.Struct('<24sQQ')
+
+
+def cache_key(raw: bytes) -> str:
+    """Return the cache key of aquery output: a hash of it, of the format version and of the schema"""
+    h = hashlib.sha256()
+    h.update(b'%d\0' % FORMAT_VERSION)
+    h.update(hashlib.sha256(DESCRIPTOR.serialized_pb).digest())
+    h.update(raw)
+    return h.hexdigest()
+
+
+def parse_cached(raw: bytes, cache_dir: str | os.PathLike[str], max_size: int | None = DEFAULT_MAX_SIZE,
+                 on_phase: PhaseCallback | None = None,
+                 dep_set_cache_size: int | None = DEFAULT_DEP_SET_CACHE_SIZE) -> ActionGraph:
+    """Load the graph of `raw` from the cache, parsing it and adding it to the cache on a miss"""
+    phase = _PhaseTimer(on_phase)
+    cache_dir = Path(cache_dir)
+    path = cache_dir / (cache_key(raw) + SUFFIX)
+    phase('hash', len(raw))
+    graph = load(path, dep_set_cache_size)
+    if graph is not None:
+        phase('load', len(graph))
+        # The modification time marks recent use, for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return graph
+    aquery = ActionGraphContainer()
+    aquery.ParseFromString(raw)
+    phase('decode', len(aquery.actions))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # The file is mapped before it is renamed into place, so evictions by other processes can't remove
+    # it before it is loaded
+    mm = write(path, aquery)
+    if max_size is not None:
+        evict(cache_dir, max_size, keep=path)
+    phase('write', len(aquery.actions))
+    graph = _load(mm, dep_set_cache_size)
+    assert graph is not None
+    phase('load', len(graph))
+    return graph
+
+
+def write(path: Path, aquery: Any) -> mmap.mmap:
+    """Write the cache file of an ActionGraphContainer, atomically, and return a memory map of it"""
+    sections: dict[str, bytes] = {}
+
+    path_fragments = {x.id: x for x in aquery.path_fragments}
+    paths: dict[int, str] = {}
+    artifacts = sorted(aquery.artifacts, key=lambda x: x.id)
+    sections['artifact_ids'] = array('I', [x.id for x in artifacts]).tobytes()
+    sections['artifact_flags'] = bytes(x.is_tree_artifact for x in artifacts)
+    encoded = [get_path(x.path_fragment_id, path_fragments, paths).encode() for x in artifacts]
+    sections['path_offsets'] = _offsets(encoded)
+    sections['paths'] = b''.join(encoded)
+
+    actions = [a.SerializeToString() for a in aquery.actions]
+    sections['action_offsets'] = _offsets(actions)
+    sections['actions'] = b''.join(actions)
+
+    dep_sets = sorted(aquery.dep_set_of_files, key=lambda x: x.id)
+    sections['dep_set_ids'] = array('I', [x.id for x in dep_sets]).tobytes()
+    sections['transitive_offsets'] = _offsets([x.transitive_dep_set_ids for x in dep_sets])
+    sections['transitive_ids'] = array('I', [i for x in dep_sets for i in x.transitive_dep_set_ids]).tobytes()
+    sections['direct_offsets'] = _offsets([x.direct_artifact_ids for x in dep_sets])
+    sections['direct_ids'] = array('I', [i for x in dep_sets for i in x.direct_artifact_ids]).tobytes()
+
+    tables = ActionGraphContainer()
+    tables.targets.extend(aquery.targets)
+    tables.rule_classes.extend(aquery.rule_classes)
+    tables.configuration.extend(aquery.configuration)
+    tables.aspect_descriptors.extend(aquery.aspect_descriptors)
+    sections['tables'] = tables.SerializeToString()
+
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp-', suffix=SUFFIX)
+    try:
+        with os.fdopen(fd, 'w+b') as f:
+            _write_sections(f, sections)
+            f.flush()
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return mm
+
+
+def load(path: Path, dep_set_cache_size: int | None = DEFAULT_DEP_SET_CACHE_SIZE) -> ActionGraph | None:
+    """Load a cache file, or return None if it doesn't exist or isn't valid"""
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    return _load(mm, dep_set_cache_size)
+
+
+def _load(mm: mmap.mmap, dep_set_cache_size: int | None) -> ActionGraph | None:
+    # Files with missing, misaligned or undecodable sections are treated as misses
+    try:
+        sections = _read_sections(mm)
+        if sections is None:
+            return None
+        tables = ActionGraphContainer()
+        tables.ParseFromString(sections['tables'])
+        t = _LazyTables(tables, dep_set_cache_size)
+        t.artifacts = _LazyTable(_Artifacts(sections), lambda x: x)
+        t.dep_set_entries = _DepSetEntries(sections)
+        t.dep_sets = _LazyTable(t.dep_set_entries, t.make_dep_set)
+        t.expander = DepSetExpander(t.dep_set_entries, t.artifacts, dep_set_cache_size)
+        actions = _Actions(sections, t)
+    except (KeyError, TypeError, ValueError, UnicodeDecodeError, struct.error, DecodeError):
+        return None
+    return ActionGraph(actions, t)
+
+
+def evict(cache_dir: Path, max_size: int, keep: Path | None = None, suffix: str = SUFFIX) -> None:
+    """Remove the least recently used cache files until their total size is at most max_size"""
+    entries = []
+    for p in cache_dir.glob('*' + suffix):
+        if p.name.startswith('.'):
+            continue
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, p in entries:
+        if total <= max_size:
+            break
+        if p == keep:
+            continue
+        try:
+            p.unlink()
+        except OSError:
+            continue
+        total -= size
+
+
+def _offsets(items: Sequence[Any]) -> bytes:
+    offsets = array('Q', [0])
+    n = 0
+    for x in items:
+        n += len(x)
+        offsets.append(n)
+    return offsets.tobytes()
+
+
+def _write_sections(f: Any, sections: dict[str, bytes]) -> None:
+    pos = _HEADER.size + _SECTION.size * len(sections)
+    index = []
+    for name, data in sections.items():
+        pos = (pos + 7) & ~7
+        assert len(name) <= 24
+        index.append(_SECTION.pack(name.encode(), pos, len(data)))
+        pos += len(data)
+    f.write(_HEADER.pack(_MAGIC, FORMAT_VERSION, len(sections)))
+    f.write(b''.join(index))
+    for name, data in sections.items():
+        f.write(b'\0' * (-f.tell() % 8))
+        f.write(data)
+
+
+def _read_sections(mm: mmap.mmap) -> dict[str, memoryview] | None:
+    if len(mm) < _HEADER.size:
+        return None
+    magic, version, count = _HEADER.unpack_from(mm)
+    if magic != _MAGIC or version != FORMAT_VERSION:
+        return None
+    view = memoryview(mm)
+    sections = {}
+    for i in range(count):
+        name, offset, size = _SECTION.unpack_from(mm, _HEADER.size + i * _SECTION.size)
+        if offset + size > len(mm):
+            return None
+        sections[name.rstrip(b'\0').decode()] = view[offset:offset + size]
+    return sections
+
+
+class _Artifacts(Mapping[int, Artifact]):
+    """The artifacts of a cache file, by id"""
+
+    def __init__(self, sections: dict[str, memoryview]):
+        self.ids = sections['artifact_ids'].cast('I')
+        self.flags = sections['artifact_flags']
+        self.offsets = sections['path_offsets'].cast('Q')
+        self.paths = sections['paths']
+
+    def __getitem__(self, artifact_id: int) -> Artifact:
+        i = _index(self.ids, artifact_id)
+        path = str(self.paths[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+        return Artifact(sys.intern(path), bool(self.flags[i]))
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+class _DepSetEntries(Mapping[int, _DepSetEntry]):
+    """The dep sets of a cache file, by id, with the same fields as DepSetOfFiles messages"""
+
+    def __init__(self, sections: dict[str, memoryview]):
+        self.ids = sections['dep_set_ids'].cast('I')
+        self.transitive_offsets = sections['transitive_offsets'].cast('Q')
+        self.transitive_ids = sections['transitive_ids'].cast('I')
+        self.direct_offsets = sections['direct_offsets'].cast('Q')
+        self.direct_ids = sections['direct_ids'].cast('I')
+
+    def __getitem__(self, dep_set_id: int) -> _DepSetEntry:
+        i = _index(self.ids, dep_set_id)
+        return _DepSetEntry(
+            dep_set_id,
+            self.transitive_ids[self.transitive_offsets[i]:self.transitive_offsets[i + 1]],
+            self.direct_ids[self.direct_offsets[i]:self.direct_offsets[i + 1]],
+        )
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+class _Actions(Sequence[ActionView]):
+    """The actions of a cache file, which are parsed on first access"""
+
+    def __init__(self, sections: dict[str, memoryview], t: _LazyTables):
+        self.offsets = sections['action_offsets'].cast('Q')
+        self.data = sections['actions']
+        self.t = t
+        self.views: dict[int, ActionView] = {}
+
+    def __getitem__(self, i: Any) -> Any:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        view = self.views.get(i)
+        if view is None:
+            msg = ActionProto.FromString(self.data[self.offsets[i]:self.offsets[i + 1]])
+            view = self.views[i] = self.t.make_action(msg)
+        return view
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+
+def _index(ids: Sequence[int], key: int) -> int:
+    i = bisect_left(ids, key)
+    if i == len(ids) or ids[i] != key:
+        raise KeyError(key)
+    return i
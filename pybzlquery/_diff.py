@@ -0,0 +1,258 @@
+"""
+Diffing of two action graphs.
+
+Each action is hashed once from its canonical content. Its inputs are hashed as a Merkle
+hash of its dep sets, so that inputs are only flattened and compared for actions whose dep
+set hashes differ. Actions with equal hashes are skipped without being converted.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from hashlib import blake2b
+from typing import Any, Callable, Iterator, Mapping
+
+from . import ActionView, DepSetExpander, _DepSetEntry, _LazyTables, get_path
+from .analysis_v2_pb2 import ActionGraphContainer  # type: ignore
+
+
+@dataclass
+class ActionDiff:
+    """
+    A difference between two action graphs.
+
+    `kind` is 'added', 'removed' or 'changed'. For changed actions, `changes` maps the name of
+    each changed field to its old and new values. Targets, configurations and artifacts are
+    compared by label, checksum and path. The 'inputs' entry holds the paths of the flattened
+    inputs which were removed and added. A change of the order of inputs alone isn't reported.
+    """
+    kind: str
+    key: str
+    old: ActionView | None
+    new: ActionView | None
+    changes: dict[str, tuple[Any, Any]] = field(default_factory=dict)
+
+
+class _Side:
+    """One of the graphs being compared, with its memoized paths and hashes"""
+
+    def __init__(self, raw: bytes, shared_paths: _SharedPaths):
+        self.shared_paths = shared_paths
+        self.aquery = ActionGraphContainer()
+        self.aquery.ParseFromString(raw)
+        self.t = _LazyTables(self.aquery)
+        self.artifact_entries = self.t.artifacts.entries  # type: ignore[attr-defined]
+        self.configurations = {x.id: x for x in self.aquery.configuration}
+        self.targets = {x.id: x.label for x in self.aquery.targets}
+        self.aspect_descriptors = {
+            x.id: '\0'.join([x.name] + [f'{p.key}={p.value}' for p in x.parameters])
+            for x in self.aquery.aspect_descriptors}
+        self.dep_set_hashes: dict[int, bytes] = {}
+        # Flattens dep sets into ids of paths shared by both sides, so flattened inputs can be
+        # compared as arrays without converting them into paths
+        self.path_ids: dict[int, int] = {}
+        self.expander = DepSetExpander(_PathIdDepSets(self), {})
+
+    def path(self, artifact_id: int) -> str:
+        return get_path(self.artifact_entries[artifact_id].path_fragment_id, self.t.path_fragments, self.t.paths)
+
+    def path_id(self, artifact_id: int) -> int:
+        i = self.path_ids.get(artifact_id)
+        if i is None:
+            i = self.path_ids[artifact_id] = self.shared_paths.id(self.path(artifact_id))
+        return i
+
+    def dep_set_hash(self, dep_set_id: int) -> bytes:
+        hashes = self.dep_set_hashes
+        if dep_set_id in hashes:
+            return hashes[dep_set_id]
+        entries = self.t.dep_set_entries
+        stack = [(dep_set_id, False)]
+        while stack:
+            i, children_done = stack.pop()
+            if i in hashes:
+                continue
+            entry = entries[i]
+            if not children_done:
+                stack.append((i, True))
+                stack.extend((child, False) for child in entry.transitive_dep_set_ids if child not in hashes)
+                continue
+            h = blake2b(digest_size=16)
+            for child in entry.transitive_dep_set_ids:
+                h.update(hashes[child])
+            h.update(_encode([self.path(a) for a in entry.direct_artifact_ids]))
+            hashes[i] = h.digest()
+        return hashes[dep_set_id]
+
+    def inputs_hash(self, a: Any) -> bytes:
+        return b''.join(self.dep_set_hash(i) for i in a.input_dep_set_ids)
+
+    def configuration(self, configuration_id: int) -> str:
+        x = self.configurations[configuration_id]
+        return f'{x.mnemonic}\0{x.checksum}'
+
+    def action_hash(self, a: Any) -> bytes:
+        h = blake2b(digest_size=16)
+        h.update(_encode([
+            a.mnemonic,
+            self.targets[a.target_id],
+            self.configuration(a.configuration_id),
+            *[self.aspect_descriptors[i] for i in a.aspect_descriptor_ids],
+        ]))
+        h.update(_encode(a.arguments))
+        h.update(_encode_pairs(a.environment_variables))
+        h.update(self.inputs_hash(a))
+        h.update(_encode([self.path(i) for i in a.output_ids]))
+        h.update(_encode([
+            self.path(a.primary_output_id),
+            str(a.discovers_inputs),
+            a.execution_platform,
+            a.template_content,
+            a.file_contents,
+            a.unresolved_symlink_target,
+            str(a.is_executable),
+        ]))
+        h.update(_encode_pairs(a.execution_info))
+        h.update(_encode_pairs(a.substitutions))
+        for p in a.param_files:
+            h.update(_encode([p.exec_path, *p.arguments]))
+        return h.digest()
+
+    def key(self, a: Any, key: str) -> str:
+        if key == 'action_key':
+            return a.action_key  # type: ignore[no-any-return]
+        if key == 'primary_output':
+            return self.path(a.primary_output_id)
+        raise ValueError(f'Unknown diff key: {key!r}')
+
+
+class _SharedPaths:
+    """Ids for the paths of both sides"""
+
+    def __init__(self) -> None:
+        self.ids: dict[str, int] = {}
+        self.paths: list[str] = []
+
+    def id(self, path: str) -> int:
+        i = self.ids.get(path)
+        if i is None:
+            i = self.ids[path] = len(self.paths)
+            self.paths.append(path)
+        return i
+
+
+class _PathIdDepSets(Mapping[int, _DepSetEntry]):
+    """The dep sets of a side, with ids of shared paths instead of artifact ids"""
+
+    def __init__(self, side: _Side):
+        self.side = side
+        self.entries: dict[int, _DepSetEntry] = {}
+
+    def __getitem__(self, dep_set_id: int) -> _DepSetEntry:
+        entry = self.entries.get(dep_set_id)
+        if entry is None:
+            x = self.side.t.dep_set_entries[dep_set_id]
+            entry = _DepSetEntry(dep_set_id, x.transitive_dep_set_ids,
+                                 [self.side.path_id(i) for i in x.direct_artifact_ids])
+            self.entries[dep_set_id] = entry
+        return entry
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.side.t.dep_set_entries)
+
+    def __len__(self) -> int:
+        return len(self.side.t.dep_set_entries)
+
+
+def _encode(strings: Any) -> bytes:
+    # Prefixed with the lengths, so that different lists never encode the same
+    strings = list(strings)
+    return f'{",".join(map(str, map(len, strings)))};{"".join(strings)};'.encode()
+
+
+def _encode_pairs(pairs: Any) -> bytes:
+    return _encode([s for p in pairs for s in (p.key, p.value)])
+
+
+# Compared fields of ActionView, with the conversion of their values into comparable values
+_FIELDS: dict[str, Callable[[Any], Any]] = {
+    'mnemonic': lambda v: v,
+    'target': lambda v: v.label,
+    'configuration': lambda v: (v.mnemonic, v.checksum),
+    'aspect_descriptors': lambda v: [(x.name, x.parameters) for x in v],
+    'arguments': lambda v: v,
+    'environment_variables': lambda v: v,
+    'outputs': lambda v: [x.path for x in v],
+    'primary_output': lambda v: v.path,
+    'discovers_inputs': lambda v: v,
+    'execution_info': lambda v: v,
+    'param_files': lambda v: [(x.exec_path, x.arguments) for x in v],
+    'execution_platform': lambda v: v,
+    'template_content': lambda v: v,
+    'substitutions': lambda v: v,
+    'file_contents': lambda v: v,
+    'unresolved_symlink_target': lambda v: v,
+    'is_executable': lambda v: v,
+}
+
+
+def _changes(old: _Side, new: _Side, va: ActionView, vb: ActionView) -> dict[str, tuple[Any, Any]]:
+    changes = {}
+    for name, convert in _FIELDS.items():
+        x = convert(getattr(va, name))
+        y = convert(getattr(vb, name))
+        if x != y:
+            changes[name] = (x, y)
+    if old.inputs_hash(va._msg) != new.inputs_hash(vb._msg):
+        xs = old.expander._expand_many(va._msg.input_dep_set_ids)
+        ys = new.expander._expand_many(vb._msg.input_dep_set_ids)
+        if xs != ys:
+            set_xs = set(xs)
+            set_ys = set(ys)
+            if set_xs != set_ys:
+                paths = old.shared_paths.paths
+                changes['inputs'] = ([paths[x] for x in xs if x not in set_ys],
+                                     [paths[y] for y in ys if y not in set_xs])
+    return changes
+
+
+def diff_aquery(old: bytes, new: bytes, key: str = 'primary_output') -> Iterator[ActionDiff]:
+    """
+    Compare two outputs of `bazel aquery --output=proto`, and yield the differences.
+
+    Actions are matched by `key`, which is 'primary_output' or 'action_key'. Bazel's action
+    key changes whenever the command line of an action does, so matching by action key
+    reports an action whose command line changed as removed and added. Actions which share a
+    key are matched in the order in which they appear, and the extra ones of either side are
+    reported as removed or added. Removed and changed actions are yielded in the order of `old`, and
+    then added actions in the order of `new`.
+    """
+    shared_paths = _SharedPaths()
+    o = _Side(old, shared_paths)
+    n = _Side(new, shared_paths)
+    new_keys = [n.key(b, key) for b in n.aquery.actions]
+    new_actions: dict[str, list[Any]] = {}
+    for k, b in zip(new_keys, n.aquery.actions):
+        new_actions.setdefault(k, []).append(b)
+    # The number of old actions with each key
+    old_counts: dict[str, int] = {}
+    for a in o.aquery.actions:
+        k = o.key(a, key)
+        i = old_counts.get(k, 0)
+        old_counts[k] = i + 1
+        bs = new_actions.get(k, [])
+        if i >= len(bs):
+            yield ActionDiff('removed', k, o.t.make_action(a), None)
+            continue
+        b = bs[i]
+        if o.action_hash(a) != n.action_hash(b):
+            va = o.t.make_action(a)
+            vb = n.t.make_action(b)
+            changes = _changes(o, n, va, vb)
+            if changes:
+                yield ActionDiff('changed', k, va, vb, changes)
+    new_counts: dict[str, int] = {}
+    for k, b in zip(new_keys, n.aquery.actions):
+        i = new_counts.get(k, 0)
+        new_counts[k] = i + 1
+        if i >= old_counts.get(k, 0):
+            yield ActionDiff('added', k, None, n.t.make_action(b))
@@ -0,0 +1,226 @@
+"""
+Parsing of `bazel query --output=proto` and `bazel cquery --output=proto`.
+
+Targets, rules and configured targets are lazy views over the protobuf messages, like
+ActionView. Rule attributes are decoded into Python values only when they are looked up.
+"""
+from __future__ import annotations
+
+from typing import Any, BinaryIO, Iterator, Mapping
+
+from . import ConfigurationView, _cached, _iter_delimited, _View
+from .analysis_v2_pb2 import ConfiguredTarget as ConfiguredTargetProto  # type: ignore
+from .analysis_v2_pb2 import CqueryResult  # type: ignore
+from .build_pb2 import Attribute, QueryResult  # type: ignore
+from .build_pb2 import Rule as RuleProto  # type: ignore
+from .build_pb2 import Target as TargetProto  # type: ignore
+
+_A = Attribute
+# Maps attribute types to the field which holds their value, for values which are simply copied
+_SCALAR_FIELDS = {
+    _A.INTEGER: 'int_value',
+    _A.STRING: 'string_value',
+    _A.LABEL: 'string_value',
+    _A.OUTPUT: 'string_value',
+    _A.BOOLEAN: 'boolean_value',
+}
+_LIST_FIELDS = {
+    _A.STRING_LIST: 'string_list_value',
+    _A.LABEL_LIST: 'string_list_value',
+    _A.OUTPUT_LIST: 'string_list_value',
+    _A.DISTRIBUTION_SET: 'string_list_value',
+    _A.INTEGER_LIST: 'int_list_value',
+}
+_DICT_FIELDS = {
+    _A.STRING_DICT: 'string_dict_value',
+    _A.LABEL_DICT_UNARY: 'label_dict_unary_value',
+    _A.LABEL_KEYED_STRING_DICT: 'label_keyed_string_dict_value',
+}
+_LIST_DICT_FIELDS = {
+    _A.LABEL_LIST_DICT: 'label_list_dict_value',
+    _A.STRING_LIST_DICT: 'string_list_dict_value',
+}
+
+
+def decode_attribute(attr: Any) -> Any:
+    """
+    Convert an Attribute message into a Python value.
+
+    Configurable attributes which weren't resolved, licenses and fileset entries are returned
+    as their protobuf messages.
+    """
+    if attr.HasField('selector_list'):
+        return attr.selector_list
+    t = attr.type
+    if t in _SCALAR_FIELDS:
+        return getattr(attr, _SCALAR_FIELDS[t])
+    if t in _LIST_FIELDS:
+        return list(getattr(attr, _LIST_FIELDS[t]))
+    if t in _DICT_FIELDS:
+        return {p.key: p.value for p in getattr(attr, _DICT_FIELDS[t])}
+    if t in _LIST_DICT_FIELDS:
+        return {p.key: list(p.value) for p in getattr(attr, _LIST_DICT_FIELDS[t])}
+    if t == _A.TRISTATE:
+        return _A.Tristate.Name(attr.tristate_value)
+    if t == _A.LICENSE:
+        return attr.license
+    if t == _A.FILESET_ENTRY_LIST:
+        return list(attr.fileset_list_value)
+    return attr
+
+
+class Attributes(Mapping[str, Any]):
+    """The attributes of a rule by name, which are decoded on first lookup"""
+    __slots__ = ('_attrs', '_index', '_values')
+
+    def __init__(self, attrs: Any):
+        self._attrs = attrs
+        self._index: dict[str, int] | None = None
+        self._values: dict[str, Any] = {}
+
+    def __getitem__(self, name: str) -> Any:
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+        if self._index is None:
+            self._index = {a.name: i for i, a in enumerate(self._attrs)}
+        value = self._values[name] = decode_attribute(self._attrs[self._index[name]])
+        return value
+
+    def raw(self, name: str) -> Any:
+        """Return the Attribute message of an attribute, without decoding it"""
+        if self._index is None:
+            self._index = {a.name: i for i, a in enumerate(self._attrs)}
+        return self._attrs[self._index[name]]
+
+    def __iter__(self) -> Iterator[str]:
+        return (a.name for a in self._attrs)
+
+    def __len__(self) -> int:
+        return len(self._attrs)
+
+    def __repr__(self) -> str:
+        return f'Attributes({list(self)!r})'
+
+
+class Rule(_View):
+    __slots__ = ('_name', '_rule_class', '_location', '_attributes', '_rule_inputs', '_rule_outputs',
+                 '_default_settings')
+    _fields = ('name', 'rule_class', 'location', 'attributes', 'rule_inputs', 'rule_outputs',
+               'default_settings')
+
+    name = _cached(lambda self: self._msg.name)
+    rule_class = _cached(lambda self: self._msg.rule_class)
+    location = _cached(lambda self: self._msg.location)
+    attributes = _cached(lambda self: Attributes(self._msg.attribute))
+    rule_inputs = _cached(lambda self: list(self._msg.rule_input))
+    rule_outputs = _cached(lambda self: list(self._msg.rule_output))
+    default_settings = _cached(lambda self: list(self._msg.default_setting))
+
+    def __reduce__(self) -> Any:
+        return _unpickle_rule, (self._msg.SerializeToString(),)
+
+
+def _target_message(msg: Any) -> Any:
+    return getattr(msg, _TARGET_FIELDS[msg.type])
+
+
+_TARGET_FIELDS = {
+    TargetProto.RULE: 'rule',
+    TargetProto.SOURCE_FILE: 'source_file',
+    TargetProto.GENERATED_FILE: 'generated_file',
+    TargetProto.PACKAGE_GROUP: 'package_group',
+    TargetProto.ENVIRONMENT_GROUP: 'environment_group',
+}
+
+
+class QueryTarget(_View):
+    """A target of query output: a rule, a source or generated file, or a package or environment group"""
+    __slots__ = ('_type', '_name', '_location', '_rule', '_generating_rule')
+    _fields = ('type', 'name', 'location', 'rule', 'generating_rule')
+
+    type = _cached(lambda self: TargetProto.Discriminator.Name(self._msg.type))
+    name = _cached(lambda self: _target_message(self._msg).name)
+    location = _cached(lambda self: getattr(_target_message(self._msg), 'location', ''))
+    rule = _cached(lambda self: Rule(self._msg.rule, None) if self._msg.type == TargetProto.RULE else None)
+    generating_rule = _cached(
+        lambda self: self._msg.generated_file.generating_rule
+        if self._msg.type == TargetProto.GENERATED_FILE else None)
+
+    def __reduce__(self) -> Any:
+        # Protobuf messages of this package can't be pickled, so pickle their serialization
+        return _unpickle_query_target, (self._msg.SerializeToString(),)
+
+
+class ConfiguredTarget(_View):
+    """A target of cquery output, with the configuration it was analyzed in"""
+    __slots__ = ('_target', '_configuration')
+    _fields = ('target', 'configuration')
+
+    target = _cached(lambda self: QueryTarget(self._msg.target, None))
+    configuration = _cached(lambda self: _configuration(self._msg, self._t))
+
+    def __reduce__(self) -> Any:
+        msg = ConfiguredTargetProto()
+        msg.CopyFrom(self._msg)
+        configuration = self.configuration
+        if configuration is not None:
+            msg.configuration.CopyFrom(configuration._msg)
+        return _unpickle_configured_target, (msg.SerializeToString(),)
+
+
+def _configuration(msg: Any, configurations: dict[int, Any]) -> ConfigurationView | None:
+    if msg.HasField('configuration'):
+        return ConfigurationView(msg.configuration, None)
+    x = configurations.get(msg.configuration_id)
+    return ConfigurationView(x, None) if x is not None else None
+
+
+def _unpickle_rule(raw: bytes) -> Rule:
+    return Rule(RuleProto.FromString(raw), None)
+
+
+def _unpickle_query_target(raw: bytes) -> QueryTarget:
+    return QueryTarget(TargetProto.FromString(raw), None)
+
+
+def _unpickle_configured_target(raw: bytes) -> ConfiguredTarget:
+    return ConfiguredTarget(ConfiguredTargetProto.FromString(raw), {})
+
+
+def parse_query(raw: bytes) -> list[QueryTarget]:
+    """Parse the output of `bazel query --output=proto`"""
+    result = QueryResult()
+    result.ParseFromString(raw)
+    return [QueryTarget(x, None) for x in result.target]
+
+
+def iter_query(f: BinaryIO) -> Iterator[QueryTarget]:
+    """Parse the output of `bazel query --output=streamed_proto` incrementally"""
+    for raw in _iter_delimited(f):
+        yield QueryTarget(TargetProto.FromString(raw), None)
+
+
+def parse_cquery(raw: bytes) -> list[ConfiguredTarget]:
+    """Parse the output of `bazel cquery --output=proto`"""
+    result = CqueryResult()
+    result.ParseFromString(raw)
+    configurations = {x.id: x for x in result.configurations}
+    return [ConfiguredTarget(x, configurations) for x in result.results]
+
+
+def iter_cquery(f: BinaryIO) -> Iterator[ConfiguredTarget]:
+    """
+    Parse the output of `bazel cquery --output=streamed_proto` incrementally.
+
+    Each length-delimited message is parsed as a CqueryResult. Configurations are looked up
+    by id when they are first accessed, so they may appear after the targets which use them.
+    """
+    configurations: dict[int, Any] = {}
+    for raw in _iter_delimited(f):
+        result = CqueryResult()
+        result.ParseFromString(raw)
+        configurations.update((x.id, x) for x in result.configurations)
+        for x in result.results:
+            yield ConfiguredTarget(x, configurations)
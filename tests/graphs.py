@@ -0,0 +1,93 @@
+"""Small hand-built action graphs for the tests"""
+from __future__ import annotations
+
+from typing import Any, Sequence
+
+from google.protobuf.internal.encoder import _VarintBytes  # type: ignore
+
+from pybzlquery.analysis_v2_pb2 import ActionGraphContainer  # type: ignore
+
+FIELDS = ('path_fragments', 'artifacts', 'rule_classes', 'targets', 'configuration',
+          'aspect_descriptors', 'dep_set_of_files', 'actions')
+
+
+class Builder:
+    """Adds entries to an ActionGraphContainer, with paths split into path fragments"""
+
+    def __init__(self) -> None:
+        self.g = ActionGraphContainer()
+        self.fragments: dict[tuple[str, ...], int] = {}
+        self.artifact_ids: dict[str, int] = {}
+        self.g.rule_classes.add(id=1, name='cc_library')
+        self.g.configuration.add(id=1, mnemonic='k8-fastbuild', platform_name='k8', checksum='abc')
+        self.g.targets.add(id=1, label='//pkg:target', rule_class_id=1)
+
+    def artifact(self, path: str) -> int:
+        if path not in self.artifact_ids:
+            parent = 0
+            parts = tuple(path.split('/'))
+            for n in range(1, len(parts) + 1):
+                if parts[:n] not in self.fragments:
+                    self.fragments[parts[:n]] = len(self.fragments) + 1
+                    self.g.path_fragments.add(id=self.fragments[parts[:n]], label=parts[n - 1], parent_id=parent)
+                parent = self.fragments[parts[:n]]
+            self.artifact_ids[path] = len(self.artifact_ids) + 1
+            self.g.artifacts.add(id=self.artifact_ids[path], path_fragment_id=parent)
+        return self.artifact_ids[path]
+
+    def dep_set(self, direct: Sequence[str] = (), transitive: Sequence[int] = ()) -> int:
+        i = len(self.g.dep_set_of_files) + 1
+        self.g.dep_set_of_files.add(id=i, direct_artifact_ids=[self.artifact(p) for p in direct],
+                                    transitive_dep_set_ids=transitive)
+        return i
+
+    def action(self, key: str, output: str, inputs: Sequence[int] = (), arguments: Sequence[str] = ('gcc',),
+               mnemonic: str = 'CppCompile', **kwargs: Any) -> Any:
+        o = self.artifact(output)
+        return self.g.actions.add(action_key=key, mnemonic=mnemonic, target_id=1, configuration_id=1,
+                                  arguments=arguments, input_dep_set_ids=inputs, output_ids=[o],
+                                  primary_output_id=o, **kwargs)
+
+    def raw(self) -> bytes:
+        return self.g.SerializeToString()  # type: ignore[no-any-return]
+
+
+def components(g: Any) -> list[bytes]:
+    """Return the ActionGraphComponents of `--output=streamed_proto`, one per entry"""
+    r = []
+    for name in FIELDS:
+        for x in getattr(g, name):
+            component = ActionGraphContainer()
+            getattr(component, name).add().CopyFrom(x)
+            r.append(component.SerializeToString())
+    return r
+
+
+def delimited(messages: Sequence[bytes]) -> bytes:
+    return b''.join(_VarintBytes(len(m)) + m for m in messages)
+
+
+def two_compiles(hdrs: Sequence[str] = ('src/a.h', 'src/b.h'), arguments: Sequence[str] = ('gcc', '-c', 'src/a.cc'),
+                 path: str = '/bin', extra: Sequence[tuple[str, str]] = ()) -> Builder:
+    """
+    Two compile actions, k0 and k1, which share a dep set of headers.
+
+    The arguments change the headers, the arguments of k0, the PATH of k1, and add actions by
+    key and output.
+    """
+    b = Builder()
+    headers = b.dep_set(hdrs)
+    b.action('k0', 'bin/a.o', [b.dep_set(['src/a.cc'], [headers])], arguments)
+    b.action('k1', 'bin/b.o', [headers], ['gcc', '-c', 'src/b.cc'],
+             environment_variables=[{'key': 'PATH', 'value': path}])
+    for key, output in extra:
+        b.action(key, output)
+    return b
+
+
+def chain(b: Builder, depth: int) -> int:
+    """Add `depth` nested dep sets, whose direct artifacts are src/0.h and up, and return the outermost"""
+    dep_set = b.dep_set(['src/0.h'])
+    for i in range(1, depth):
+        dep_set = b.dep_set([f'src/{i}.h'], [dep_set])
+    return dep_set
@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from graphs import Builder, chain
+
+from pybzlquery import parse_action_graph
+
+
+def make_graph(depth: int = 3) -> Builder:
+    b = Builder()
+    b.action('k0', 'bin/a.o', [chain(b, depth)])
+    b.action('k1', 'bin/b.o', [b.dep_set(['src/b.cc', 'src/0.h'])])
+    b.action('k2', 'bin/lib.a', [b.dep_set(['bin/a.o', 'bin/b.o'])], mnemonic='CppArchive')
+    return b
+
+
+def test_lookups() -> None:
+    for lazy in (False, True):
+        graph = parse_action_graph(make_graph().raw(), lazy=lazy)
+        assert len(graph) == 3
+        producer = graph.producing_action('bin/b.o')
+        assert producer is not None and producer.action_key == 'k1'
+        assert graph.producing_action('src/b.cc') is None
+        assert [a.action_key for a in graph.actions_of_label('//pkg:target')] == ['k0', 'k1', 'k2']
+        assert [a.action_key for a in graph.actions_with_mnemonic('CppArchive')] == ['k2']
+        assert [a.action_key for a in graph.consuming_actions('src/0.h')] == ['k0', 'k1']
+        assert [a.action_key for a in graph.consuming_actions('bin/a.o')] == ['k2']
+        assert graph.consuming_actions('missing') == []
+
+
+def test_consuming_actions_of_deep_dep_sets() -> None:
+    for lazy in (False, True):
+        graph = parse_action_graph(make_graph(depth=1000).raw(), lazy=lazy)
+        assert [a.action_key for a in graph.consuming_actions('src/999.h')] == ['k0']
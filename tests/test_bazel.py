@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import stat
+import sys
+import textwrap
+import threading
+from pathlib import Path
+from subprocess import CalledProcessError
+from typing import Any
+
+import pytest
+from graphs import components, delimited, two_compiles
+
+from pybzlquery import Bazel
+from pybzlquery.build_pb2 import Target  # type: ignore
+
+# Writes its arguments to `calls`, waits for `delay` seconds if that file exists, writes the canned
+# output of the command, and then exits with the status in `status` if that file exists
+FAKE_BAZEL = '''\
+    import os, sys, time
+    d = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(d, 'calls'), 'a') as f:
+        f.write(' '.join(sys.argv[1:]) + '\\n')
+    if os.path.exists(os.path.join(d, 'delay')):
+        time.sleep(float(open(os.path.join(d, 'delay')).read()))
+    sys.stdout.buffer.write(open(os.path.join(d, sys.argv[1] + '.out'), 'rb').read())
+    sys.exit(int(open(os.path.join(d, 'status')).read()) if os.path.exists(os.path.join(d, 'status')) else 0)
+'''
+
+
+class FakeBazel:
+    def __init__(self, root: Path):
+        self.root = root
+        self.path = root / 'bazel'
+        self.path.write_text(f'#!{sys.executable}\n' + textwrap.dedent(FAKE_BAZEL))
+        self.path.chmod(self.path.stat().st_mode | stat.S_IXUSR)
+        self.write('aquery', delimited(components(two_compiles().g)))
+        targets = []
+        for name in ('//pkg:a', '//pkg:b'):
+            t = Target(type=Target.RULE)
+            t.rule.name = name
+            t.rule.rule_class = 'cc_library'
+            targets.append(t.SerializeToString())
+        self.write('query', delimited(targets))
+
+    def write(self, command: str, output: bytes) -> None:
+        (self.root / (command + '.out')).write_bytes(output)
+
+    def set(self, name: str, value: object) -> None:
+        (self.root / name).write_text(str(value))
+
+    def calls(self) -> list[str]:
+        path = self.root / 'calls'
+        return path.read_text().splitlines() if path.exists() else []
+
+
+@pytest.fixture
+def fake(tmp_path: Path) -> FakeBazel:
+    (tmp_path / 'bin').mkdir()
+    return FakeBazel(tmp_path / 'bin')
+
+
+def make_bazel(fake: FakeBazel, tmp_path: Path, **kwargs: Any) -> Bazel:
+    return Bazel(tmp_path, bazel=str(fake.path), workspace_state=lambda workspace: 'state', **kwargs)
+
+
+def test_sync_queries(fake: FakeBazel, tmp_path: Path) -> None:
+    bazel = make_bazel(fake, tmp_path)
+    actions = bazel.aquery('//pkg:all', '--config=opt')
+    assert [a.action_key for a in actions] == ['k0', 'k1']
+    assert [x.path for x in actions[0].inputs()] == ['src/a.h', 'src/b.h', 'src/a.cc']
+    assert [t.name for t in bazel.query('//pkg:all')] == ['//pkg:a', '//pkg:b']
+    assert fake.calls() == ['aquery --output=streamed_proto --config=opt //pkg:all',
+                            'query --output=streamed_proto //pkg:all']
+
+
+def test_async_queries(fake: FakeBazel, tmp_path: Path) -> None:
+    async def run(bazel: Bazel) -> tuple[list[Any], list[Any]]:
+        return await asyncio.gather(bazel.aquery_async('//pkg:all'), bazel.query_async('//pkg:all'))
+
+    with make_bazel(fake, tmp_path, max_workers=2) as bazel:
+        actions, targets = asyncio.run(run(bazel))
+    assert [a.action_key for a in actions] == ['k0', 'k1']
+    assert [t.rule.rule_class for t in targets] == ['cc_library', 'cc_library']
+
+
+def test_async_queries_compute_the_workspace_state_off_the_event_loop(fake: FakeBazel, tmp_path: Path) -> None:
+    threads = []
+
+    def workspace_state(workspace: Any) -> str:
+        threads.append(threading.get_ident())
+        return 'state'
+
+    async def run(bazel: Bazel) -> tuple[int, list[Any]]:
+        return threading.get_ident(), await bazel.aquery_async('//pkg:all')
+
+    with Bazel(tmp_path, bazel=str(fake.path), cache_dir=tmp_path / 'cache', workspace_state=workspace_state,
+               max_workers=1) as bazel:
+        loop_thread, actions = asyncio.run(run(bazel))
+    assert [a.action_key for a in actions] == ['k0', 'k1']
+    assert len(threads) == 1
+    assert loop_thread not in threads
+
+
+def test_pooled_actions_have_an_expander(fake: FakeBazel, tmp_path: Path) -> None:
+    with make_bazel(fake, tmp_path, max_workers=1) as bazel:
+        actions = bazel.submit('aquery', '//pkg:all').result()
+    k0, k1 = actions
+    headers = k1.input_dep_sets[0]
+    assert headers.expander is not None
+    assert k0.input_dep_sets[0].transitive_dep_sets[0].expander is headers.expander
+    assert [x.path for x in k0.inputs()] == ['src/a.h', 'src/b.h', 'src/a.cc']
+    assert [x.path for x in k1.inputs()] == ['src/a.h', 'src/b.h']
+    assert k0.inputs()[0] is k1.inputs()[0]
+
+
+def test_identical_queries_in_flight_are_coalesced(fake: FakeBazel, tmp_path: Path) -> None:
+    fake.set('delay', 0.5)
+    with make_bazel(fake, tmp_path, max_workers=2) as bazel:
+        first = bazel.submit('aquery', '//pkg:all')
+        second = bazel.submit('aquery', '//pkg:all')
+        other = bazel.submit('aquery', '//other:all')
+        assert first is second
+        assert other is not first
+        assert [a.action_key for a in first.result()] == ['k0', 'k1']
+        other.result()
+        # Once done, the same query runs again
+        bazel.submit('aquery', '//pkg:all').result()
+    assert sorted(fake.calls()) == ['aquery --output=streamed_proto //other:all'] + 2 * [
+        'aquery --output=streamed_proto //pkg:all']
+
+
+def test_cache_hits(fake: FakeBazel, tmp_path: Path) -> None:
+    state = ['one']
+    bazel = Bazel(tmp_path, bazel=str(fake.path), cache_dir=tmp_path / 'cache',
+                  workspace_state=lambda workspace: state[0])
+    first = bazel.aquery('//pkg:all')
+    assert [a.action_key for a in bazel.aquery('//pkg:all')] == [a.action_key for a in first]
+    assert len(fake.calls()) == 1
+    bazel.aquery('//pkg:all', '--config=opt')
+    assert len(fake.calls()) == 2
+    state[0] = 'two'
+    bazel.aquery('//pkg:all')
+    assert len(fake.calls()) == 3
+
+
+def test_workspace_without_state_is_not_cached(fake: FakeBazel, tmp_path: Path) -> None:
+    bazel = Bazel(tmp_path, bazel=str(fake.path), cache_dir=tmp_path / 'cache',
+                  workspace_state=lambda workspace: None)
+    bazel.aquery('//pkg:all')
+    bazel.aquery('//pkg:all')
+    assert len(fake.calls()) == 2
+    assert not (tmp_path / 'cache').exists()
+
+
+def test_corrupt_cache_file_is_a_miss(fake: FakeBazel, tmp_path: Path) -> None:
+    bazel = make_bazel(fake, tmp_path, cache_dir=tmp_path / 'cache')
+    bazel.aquery('//pkg:all')
+    path, = (tmp_path / 'cache').iterdir()
+    path.write_bytes(path.read_bytes()[:-5])
+    assert [a.action_key for a in bazel.aquery('//pkg:all')] == ['k0', 'k1']
+    assert len(fake.calls()) == 2
+    assert [a.action_key for a in bazel.aquery('//pkg:all')] == ['k0', 'k1']
+    assert len(fake.calls()) == 2
+
+
+def test_non_zero_exit(fake: FakeBazel, tmp_path: Path) -> None:
+    fake.set('status', 1)
+    bazel = make_bazel(fake, tmp_path, cache_dir=tmp_path / 'cache')
+    with pytest.raises(CalledProcessError):
+        bazel.aquery('//pkg:all')
+    # Truncated output is reported as the failure of bazel
+    fake.write('aquery', (fake.root / 'aquery.out').read_bytes()[:-5])
+    with pytest.raises(CalledProcessError):
+        bazel.aquery('//pkg:all')
+    assert os.listdir(tmp_path / 'cache') == []
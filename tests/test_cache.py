@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any
+
+import pytest
+from graphs import two_compiles
+
+from pybzlquery import _cache, parse_action_graph, parse_aquery
+
+
+def summary(actions: Any) -> list[tuple[Any, ...]]:
+    return [(a.action_key, a.mnemonic, a.target.label, a.configuration.checksum, a.arguments,
+             a.environment_variables, [x.path for x in a.outputs], [x.path for x in a.inputs()])
+            for a in actions]
+
+
+def test_round_trip(tmp_path: Path) -> None:
+    raw = two_compiles().raw()
+    expected = summary(parse_aquery(raw))
+    phases: list[str] = []
+    miss = parse_aquery(raw, lazy=True, cache_dir=tmp_path, on_phase=lambda name, seconds, count: phases.append(name))
+    assert phases == ['hash', 'decode', 'write', 'load']
+    assert summary(miss) == expected
+    phases.clear()
+    hit = parse_action_graph(raw, lazy=True, cache_dir=tmp_path,
+                             on_phase=lambda name, seconds, count: phases.append(name))
+    assert phases == ['hash', 'load']
+    assert summary(hit) == expected
+    assert [a.action_key for a in hit.consuming_actions('src/a.h')] == ['k0', 'k1']
+    assert len(list(tmp_path.glob('*' + _cache.SUFFIX))) == 1
+
+
+def test_invalid_files_are_misses(tmp_path: Path) -> None:
+    raw = two_compiles().raw()
+    path = tmp_path / (_cache.cache_key(raw) + _cache.SUFFIX)
+    path.write_bytes(b'PBZQGRPH garbage')
+    assert summary(parse_aquery(raw, lazy=True, cache_dir=tmp_path)) == summary(parse_aquery(raw))
+
+
+def test_files_without_sections_are_misses(tmp_path: Path) -> None:
+    raw = two_compiles().raw()
+    path = tmp_path / (_cache.cache_key(raw) + _cache.SUFFIX)
+    for data in (_cache._HEADER.pack(_cache._MAGIC, _cache.FORMAT_VERSION, 0),
+                 _cache._HEADER.pack(_cache._MAGIC, _cache.FORMAT_VERSION, 1) + b'\xff' * _cache._SECTION.size,
+                 _cache._HEADER.pack(_cache._MAGIC, _cache.FORMAT_VERSION, 2)):
+        path.write_bytes(data)
+        assert _cache.load(path) is None
+        assert summary(parse_aquery(raw, lazy=True, cache_dir=tmp_path)) == summary(parse_aquery(raw))
+
+
+def test_cache_dir_requires_lazy(tmp_path: Path) -> None:
+    with pytest.raises(ValueError):
+        parse_action_graph(two_compiles().raw(), cache_dir=tmp_path)
+
+
+def test_eviction_by_another_process_after_write(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    def evict_everything(cache_dir: Path, max_size: int, keep: Path | None = None) -> None:
+        for p in cache_dir.iterdir():
+            p.unlink()
+
+    monkeypatch.setattr(_cache, 'evict', evict_everything)
+    raw = two_compiles().raw()
+    assert summary(parse_aquery(raw, lazy=True, cache_dir=tmp_path)) == summary(parse_aquery(raw))
+
+
+def test_eviction(tmp_path: Path) -> None:
+    raws = []
+    for i in range(3):
+        raws.append(two_compiles(extra=[(f'extra{i}', f'bin/extra{i}.o')]).raw())
+    parse_aquery(raws[0], lazy=True, cache_dir=tmp_path)
+    size = sum(p.stat().st_size for p in tmp_path.iterdir())
+    for raw in raws[1:]:
+        parse_aquery(raw, lazy=True, cache_dir=tmp_path, max_cache_size=2 * size)
+    names = {p.name for p in tmp_path.iterdir()}
+    assert names == {_cache.cache_key(raw) + _cache.SUFFIX for raw in raws[1:]}
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import copy
+import pickle
+from typing import Any, Sequence
+
+from graphs import Builder
+
+from pybzlquery import Artifact, DepSetOfFiles, parse_action_graph, parse_aquery
+
+
+def make_graph() -> Builder:
+    b = Builder()
+    common = b.dep_set(['c.h'])
+    left = b.dep_set(['l.h', 'c.h'], [common])
+    right = b.dep_set(['r.h'], [common])
+    top = b.dep_set(['a.cc', 'l.h'], [left, right])
+    b.action('k0', 'a.o', [top, b.dep_set(['z.h', 'r.h'])])
+    return b
+
+
+def paths(artifacts: Sequence[Any]) -> list[str]:
+    return [x.path for x in artifacts]
+
+
+def test_flatten_is_postorder_and_deduplicated() -> None:
+    for lazy in (False, True):
+        a, = parse_aquery(make_graph().raw(), lazy=lazy)
+        top = a.input_dep_sets[0]
+        assert paths(top.flatten()) == ['c.h', 'l.h', 'r.h', 'a.cc']
+        assert paths(top.transitive_dep_sets[1].flatten()) == ['c.h', 'r.h']
+        assert paths(a.inputs()) == ['c.h', 'l.h', 'r.h', 'a.cc', 'z.h']
+
+
+def test_flatten_without_expander_has_the_same_order() -> None:
+    c = Artifact('c.h', False)
+    common = DepSetOfFiles([], [c])
+    left = DepSetOfFiles([common], [Artifact('l.h', False), c])
+    right = DepSetOfFiles([common], [Artifact('r.h', False)])
+    top = DepSetOfFiles([left, right], [Artifact('a.cc', False)])
+    assert paths(top.flatten()) == ['c.h', 'l.h', 'r.h', 'a.cc']
+
+
+def test_pickles_and_copies_of_an_action_do_not_include_the_graph() -> None:
+    b = make_graph()
+    for i in range(200):
+        b.action(f'other{i}', f'other{i}.o', [b.dep_set([f'other{i}.cc'])])
+    a = parse_aquery(b.raw())[0]
+    small = parse_aquery(make_graph().raw())[0]
+    data = pickle.dumps(a)
+    assert len(data) == len(pickle.dumps(small))
+    for x in (pickle.loads(data), copy.deepcopy(a)):
+        assert x.input_dep_sets[0].expander is None
+        assert paths(x.inputs()) == ['c.h', 'l.h', 'r.h', 'a.cc', 'z.h']
+
+
+def test_expanded_arrays_are_copies() -> None:
+    graph = parse_action_graph(make_graph().raw())
+    a, = graph.actions
+    top, other = [x.id for x in a.input_dep_sets]
+    ids = graph.expander.expand(top)
+    ids.append(0)
+    graph.expander.expand_many([other]).append(0)
+    assert 0 not in graph.expander.expand(top)
+    assert 0 not in graph.expander.expand(other)
+    assert paths(a.inputs()) == ['c.h', 'l.h', 'r.h', 'a.cc', 'z.h']
+
+
+def test_dep_set_cache_size() -> None:
+    for lazy in (False, True):
+        graph = parse_action_graph(make_graph().raw(), lazy=lazy, dep_set_cache_size=2)
+        a, = graph.actions
+        assert paths(a.inputs()) == ['c.h', 'l.h', 'r.h', 'a.cc', 'z.h']
+        assert graph.expander.maxsize == 2
+        assert len(graph.expander._cache) == 2
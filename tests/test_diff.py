@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+from typing import Any
+
+from graphs import Builder, two_compiles
+
+from pybzlquery import diff_aquery
+
+
+def summary(old: Builder, new: Builder, key: str = 'primary_output') -> list[tuple[str, str, dict[str, Any]]]:
+    return [(d.kind, d.key, d.changes) for d in diff_aquery(old.raw(), new.raw(), key)]
+
+
+def test_identical_graphs() -> None:
+    assert summary(two_compiles(), two_compiles()) == []
+
+
+def test_changed_fields() -> None:
+    assert summary(two_compiles(), two_compiles(path='/usr/bin', hdrs=['src/a.h', 'src/c.h'])) == [
+        ('changed', 'bin/a.o', {'inputs': (['src/b.h'], ['src/c.h'])}),
+        ('changed', 'bin/b.o', {'environment_variables': ({'PATH': '/bin'}, {'PATH': '/usr/bin'}),
+                                'inputs': (['src/b.h'], ['src/c.h'])}),
+    ]
+
+
+def test_reordered_inputs_are_not_reported() -> None:
+    assert summary(two_compiles(), two_compiles(hdrs=['src/b.h', 'src/a.h'])) == []
+
+
+def test_added_and_removed() -> None:
+    old = two_compiles(extra=[('k2', 'bin/c.o')])
+    new = two_compiles(extra=[('k3', 'bin/d.o')])
+    assert summary(old, new) == [('removed', 'bin/c.o', {}), ('added', 'bin/d.o', {})]
+
+
+def test_changed_command_line() -> None:
+    # The action key changes with the command line
+    old = two_compiles(extra=[('k2', 'bin/c.o')])
+    new = two_compiles(extra=[('k2-new', 'bin/c.o')], arguments=['gcc', '-O2', '-c', 'src/a.cc'])
+    arguments = (['gcc', '-c', 'src/a.cc'], ['gcc', '-O2', '-c', 'src/a.cc'])
+    assert summary(old, new) == [('changed', 'bin/a.o', {'arguments': arguments})]
+    assert summary(old, new, key='action_key') == [
+        ('changed', 'k0', {'arguments': arguments}),
+        ('removed', 'k2', {}),
+        ('added', 'k2-new', {}),
+    ]
+
+
+def test_duplicate_keys_are_matched_in_order() -> None:
+    old = two_compiles(extra=[('dup', 'bin/c.o')])
+    new = two_compiles(extra=[('dup', 'bin/c.o'), ('dup', 'bin/d.o')])
+    diffs = list(diff_aquery(old.raw(), new.raw(), key='action_key'))
+    assert [(d.kind, d.key) for d in diffs] == [('added', 'dup')]
+    assert diffs[0].new is not None and diffs[0].new.primary_output.path == 'bin/d.o'
+    assert [(d.kind, d.key) for d in diff_aquery(new.raw(), old.raw(), key='action_key')] == [('removed', 'dup')]
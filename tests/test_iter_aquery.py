@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import io
+
+import pytest
+from graphs import components, delimited, two_compiles
+
+from pybzlquery import iter_aquery, parse_aquery
+
+
+def test_streamed_matches_parse_aquery() -> None:
+    b = two_compiles()
+    streamed = list(iter_aquery(io.BytesIO(delimited(components(b.g)))))
+    assert [a.action_key for a in streamed] == ['k0', 'k1']
+    assert [a.arguments for a in streamed] == [a.arguments for a in parse_aquery(b.raw())]
+    assert [x.path for x in streamed[0].inputs()] == ['src/a.h', 'src/b.h', 'src/a.cc']
+
+
+def test_out_of_order_entries_wait_for_their_references() -> None:
+    # Actions first, then dep sets with parents before children, then the artifacts
+    stream = list(reversed(components(two_compiles().g)))
+    actions = list(iter_aquery(io.BytesIO(delimited(stream))))
+    assert sorted(a.action_key for a in actions) == ['k0', 'k1']
+    by_key = {a.action_key: a for a in actions}
+    assert by_key['k0'].primary_output.path == 'bin/a.o'
+    assert [x.path for x in by_key['k0'].inputs()] == ['src/a.h', 'src/b.h', 'src/a.cc']
+
+
+def test_missing_references_raise() -> None:
+    g = two_compiles().g
+    stream = components(g)
+    # Drop the first artifact, which follows the path fragments
+    del stream[len(g.path_fragments)]
+    with pytest.raises(ValueError, match='missing entries'):
+        list(iter_aquery(io.BytesIO(delimited(stream))))
+
+
+def test_truncated_stream_raises() -> None:
+    data = delimited(components(two_compiles().g))
+    with pytest.raises(ValueError, match='Truncated'):
+        list(iter_aquery(io.BytesIO(data[:-3])))
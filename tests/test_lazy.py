@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+from graphs import Builder, chain
+
+from pybzlquery import DepSetOfFilesView, parse_aquery
+
+
+def make_graph(depth: int) -> Builder:
+    b = Builder()
+    b.action('k0', 'bin/a.o', [chain(b, depth)], ['gcc', '-c', 'src/a.cc'],
+             environment_variables=[{'key': 'K', 'value': 'V'}])
+    return b
+
+
+def test_lazy_matches_eager() -> None:
+    raw = make_graph(5).raw()
+    eager, = parse_aquery(raw)
+    lazy, = parse_aquery(raw, lazy=True)
+    for name in ('action_key', 'mnemonic', 'arguments', 'environment_variables', 'execution_platform'):
+        assert getattr(lazy, name) == getattr(eager, name)
+    assert lazy.target.label == eager.target.label
+    assert lazy.primary_output.path == eager.primary_output.path
+    assert [x.path for x in lazy.inputs()] == [x.path for x in eager.inputs()]
+
+
+def test_deep_dep_sets_are_built_as_accessed() -> None:
+    a, = parse_aquery(make_graph(400).raw(), lazy=True)
+    dep_set, = a.input_dep_sets
+    assert isinstance(dep_set, DepSetOfFilesView)
+    assert [x.path for x in dep_set.direct_artifacts] == ['src/399.h']
+    assert dep_set.transitive_dep_sets[0].transitive_dep_sets[0].id == dep_set.id - 2
+    assert [x.path for x in dep_set.flatten()] == [f'src/{i}.h' for i in range(400)]
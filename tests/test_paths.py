@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import sys
+
+from pybzlquery import get_path
+from pybzlquery.analysis_v2_pb2 import PathFragment  # type: ignore
+
+
+def fragments(labels: list[str]) -> dict[int, PathFragment]:
+    """A chain of path fragments, each the child of the previous one"""
+    return {i: PathFragment(id=i, label=label, parent_id=i - 1) for i, label in enumerate(labels, 1)}
+
+
+def test_chain_deeper_than_the_recursion_limit() -> None:
+    depth = sys.getrecursionlimit() + 4000
+    path = get_path(depth, fragments([f'd{i}' for i in range(depth)]))
+    assert path.count('/') == depth - 1
+    assert path.startswith('d0/d1/') and path.endswith(f'/d{depth - 1}')
+
+
+def test_memo_is_shared() -> None:
+    path_fragments = fragments(['bazel-out', 'bin', 'pkg'])
+    path_fragments[4] = PathFragment(id=4, label='a.o', parent_id=3)
+    path_fragments[5] = PathFragment(id=5, label='b.o', parent_id=3)
+    paths: dict[int, str] = {}
+    assert get_path(4, path_fragments, paths) == 'bazel-out/bin/pkg/a.o'
+    assert paths == {1: 'bazel-out', 2: 'bazel-out/bin', 3: 'bazel-out/bin/pkg', 4: 'bazel-out/bin/pkg/a.o'}
+    # Only the new fragment is resolved, from the memoized path of its parent
+    del path_fragments[1], path_fragments[2], path_fragments[3]
+    assert get_path(5, path_fragments, paths) == 'bazel-out/bin/pkg/b.o'
+    assert get_path(3, path_fragments, paths) is paths[3]
+
+
+def test_equal_paths_are_the_same_object() -> None:
+    # Built separately, without a shared memo
+    x = get_path(3, fragments(['src', 'pkg', 'a.cc']))
+    y = get_path(3, fragments(['src', 'pkg', 'a.cc']))
+    assert x == 'src/pkg/a.cc'
+    assert x is y
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import io
+import pickle
+from typing import Any
+
+from graphs import delimited
+
+from pybzlquery import iter_cquery, iter_query, parse_cquery, parse_query
+from pybzlquery.analysis_v2_pb2 import CqueryResult  # type: ignore
+from pybzlquery.build_pb2 import Attribute, QueryResult, Target  # type: ignore
+
+
+def make_rule_target() -> Any:
+    t = Target(type=Target.RULE)
+    r = t.rule
+    r.name = '//pkg:a'
+    r.rule_class = 'cc_library'
+    r.location = '/ws/pkg/BUILD:1:11'
+    r.rule_input.extend(['//pkg:a.cc', '//pkg:a.h'])
+    r.rule_output.append('//pkg:liba.a')
+    r.attribute.add(name='linkstatic', type=Attribute.BOOLEAN, boolean_value=True)
+    r.attribute.add(name='alwayslink', type=Attribute.INTEGER, int_value=1)
+    r.attribute.add(name='deps', type=Attribute.LABEL_LIST, string_list_value=['//pkg:b', '//pkg:c'])
+    r.attribute.add(name='stamp', type=Attribute.TRISTATE, tristate_value=Attribute.AUTO)
+    r.attribute.add(name='defines', type=Attribute.STRING_DICT, string_dict_value=[{'key': 'K', 'value': 'V'}])
+    r.attribute.add(name='tags', type=Attribute.LABEL_LIST_DICT,
+                    label_list_dict_value=[{'key': '//c:x', 'value': ['//pkg:x1', '//pkg:x2']}])
+    r.attribute.add(name='licenses', type=Attribute.LICENSE, license={'license_type': ['notice']})
+    copts = r.attribute.add(name='copts', type=Attribute.STRING_LIST)
+    element = copts.selector_list.elements.add()
+    element.entries.add(label='//conditions:default', string_list_value=['-O2'])
+    return t
+
+
+def make_file_target() -> Any:
+    t = Target(type=Target.GENERATED_FILE)
+    t.generated_file.name = '//pkg:liba.a'
+    t.generated_file.generating_rule = '//pkg:a'
+    t.generated_file.location = '/ws/pkg/BUILD:1:11'
+    return t
+
+
+def make_cquery_result() -> Any:
+    result = CqueryResult()
+    result.configurations.add(id=1, mnemonic='k8-fastbuild', checksum='abc')
+    by_id = result.results.add(configuration_id=1)
+    by_id.target.CopyFrom(make_rule_target())
+    inline = result.results.add()
+    inline.target.CopyFrom(make_file_target())
+    inline.configuration.mnemonic = 'k8-opt-exec'
+    inline.configuration.is_tool = True
+    return result
+
+
+def test_attributes_are_decoded_by_type() -> None:
+    result = QueryResult()
+    result.target.extend([make_rule_target(), make_file_target()])
+    rule_target, file_target = parse_query(result.SerializeToString())
+    assert (rule_target.type, rule_target.name, rule_target.location) == ('RULE', '//pkg:a', '/ws/pkg/BUILD:1:11')
+    rule = rule_target.rule
+    assert rule.rule_class == 'cc_library'
+    assert rule.rule_inputs == ['//pkg:a.cc', '//pkg:a.h']
+    assert rule.rule_outputs == ['//pkg:liba.a']
+    attrs = rule.attributes
+    assert len(attrs) == 8
+    assert attrs['linkstatic'] is True
+    assert attrs['alwayslink'] == 1
+    assert attrs['deps'] == ['//pkg:b', '//pkg:c']
+    assert attrs['stamp'] == 'AUTO'
+    assert attrs['defines'] == {'K': 'V'}
+    assert attrs['tags'] == {'//c:x': ['//pkg:x1', '//pkg:x2']}
+    assert list(attrs['licenses'].license_type) == ['notice']
+    assert attrs.raw('deps').type == Attribute.LABEL_LIST
+    assert (file_target.type, file_target.name) == ('GENERATED_FILE', '//pkg:liba.a')
+    assert file_target.rule is None
+    assert file_target.generating_rule == '//pkg:a'
+
+
+def test_unresolved_selector_list_is_returned_as_a_message() -> None:
+    result = QueryResult()
+    result.target.append(make_rule_target())
+    target, = parse_query(result.SerializeToString())
+    entry, = target.rule.attributes['copts'].elements[0].entries
+    assert (entry.label, list(entry.string_list_value)) == ('//conditions:default', ['-O2'])
+
+
+def test_streamed_query() -> None:
+    targets = list(iter_query(io.BytesIO(delimited([make_rule_target().SerializeToString(),
+                                                    make_file_target().SerializeToString()]))))
+    assert [t.name for t in targets] == ['//pkg:a', '//pkg:liba.a']
+    assert targets[0].rule.attributes['deps'] == ['//pkg:b', '//pkg:c']
+
+
+def test_cquery_configurations_by_id_and_inline() -> None:
+    by_id, inline = parse_cquery(make_cquery_result().SerializeToString())
+    assert by_id.target.name == '//pkg:a'
+    assert (by_id.configuration.mnemonic, by_id.configuration.checksum) == ('k8-fastbuild', 'abc')
+    assert inline.target.generating_rule == '//pkg:a'
+    assert (inline.configuration.mnemonic, inline.configuration.is_tool) == ('k8-opt-exec', True)
+
+
+def test_streamed_cquery_looks_up_configurations_read_later() -> None:
+    full = make_cquery_result()
+    results = CqueryResult()
+    results.results.extend(full.results)
+    configurations = CqueryResult()
+    configurations.configurations.extend(full.configurations)
+    stream = delimited([results.SerializeToString(), configurations.SerializeToString()])
+    by_id, inline = iter_cquery(io.BytesIO(stream))
+    assert by_id.configuration.mnemonic == 'k8-fastbuild'
+    assert inline.configuration.mnemonic == 'k8-opt-exec'
+
+
+def test_pickles() -> None:
+    by_id, inline = parse_cquery(make_cquery_result().SerializeToString())
+    x = pickle.loads(pickle.dumps(by_id))
+    assert (x.target.name, x.configuration.checksum) == ('//pkg:a', 'abc')
+    assert x.target.rule.attributes['deps'] == ['//pkg:b', '//pkg:c']
+    rule = pickle.loads(pickle.dumps(by_id.target.rule))
+    assert (rule.name, rule.attributes['stamp']) == ('//pkg:a', 'AUTO')
+    assert pickle.loads(pickle.dumps(inline)).configuration.is_tool is True
@@ -0,0 +1,14 @@
+from __future__ import annotations
+
+from synthetic import Shape, make_graph
+
+from pybzlquery import parse_aquery
+
+
+def test_shapes() -> None:
+    for actions in (1, 50, 101):
+        shape = Shape(actions=actions, arguments=5, argument_length=40)
+        parsed = parse_aquery(make_graph(shape).SerializeToString())
+        assert len(parsed) == actions
+        assert {a.target.label for a in parsed} >= {'//pkg1:target'}
+        assert [len(x) for x in parsed[-1].arguments] == [3] + [40] * 4